@@ -1,11 +1,30 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-import requests
-import json
 import os
+
+# 直接运行本文件(非调试模式)时使用 gevent 服务器：必须在导入 requests 等模块之前 monkey-patch
+# (Vercel / gunicorn 导入本模块时 __name__ 不是 '__main__'，不受影响)
+if __name__ == '__main__' and os.environ.get('FLASK_ENV') != 'development':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout, RequestException
+from urllib3.util.retry import Retry
+import csv
+import orjson
+import hashlib
+import random
+import re
+import threading
+import time
 import logging
 from datetime import datetime, timezone
 import uuid
-from flask import Response, stream_with_context
+from itertools import islice
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 处理导入问题
 try:
@@ -19,6 +38,29 @@ app = Flask(__name__,
             template_folder='../templates',
             static_folder='../static')
 
+# 请求体大小上限：超大请求在读取/解析 JSON 之前直接返回 413
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
+
+
+class ORJSONProvider(JSONProvider):
+    """使用 orjson 作为 Flask 的 JSON 编解码器，所有 jsonify / request.get_json 都会经过这里"""
+
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # 直接把 orjson 输出的 bytes 交给 Response，省去 decode 再 encode 的往返
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype='application/json')
+
+
+app.json = ORJSONProvider(app)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,40 +68,71 @@ logger = logging.getLogger(__name__)
 # API configuration  
 API_KEY = os.environ.get('QWEN_API_KEY', 'sk-9ec24e8e7f6544b19d5326518007ba9e')
 API_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
-
-# 简单的内存存储（生产环境建议使用数据库）
-chat_sessions = {}
+# API_KEY 进程内不会变化，只判断一次
+_API_KEY_OK = bool(API_KEY)
 
 # 加载学生配置
 def load_students_config():
     """加载学生分组配置"""
     try:
         config_path = os.path.join(os.path.dirname(__file__), '..', 'students_config.json')
-        with open(config_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(config_path, 'rb') as f:
+            return orjson.loads(f.read())
     except Exception as e:
         logger.error(f"Error loading students config: {e}")
         return {"groups": {}}
 
 STUDENTS_CONFIG = load_students_config()
 
+# 学号 -> 分组信息 的索引，加载配置时构建一次
+# 同组学生共享同一个只读字典，请求中直接引用而不复制
+_GROUP_VIEWS = {
+    group_id: MappingProxyType({
+        'group_id': group_id,
+        'group_name': group_info['name'],
+        'llm_type': group_info['llm_type'],
+        'description': group_info['description']
+    })
+    for group_id, group_info in STUDENTS_CONFIG['groups'].items()
+}
+STUDENT_INDEX = {
+    student_id.upper(): _GROUP_VIEWS[group_id]
+    for group_id, group_info in STUDENTS_CONFIG['groups'].items()
+    for student_id in group_info['students']
+}
+
 def get_student_group(student_id):
-    """根据学号获取学生所属组"""
-    for group_id, group_info in STUDENTS_CONFIG['groups'].items():
-        if student_id in group_info['students']:
-            return {
-                'group_id': group_id,
-                'group_name': group_info['name'],
-                'llm_type': group_info['llm_type'],
-                'description': group_info['description']
-            }
-    return None
+    """根据学号获取学生所属组（返回共享的只读字典）"""
+    return STUDENT_INDEX.get(student_id)
+
+# 页面模板不含任何变量，渲染结果在进程内缓存（调试模式下不缓存，便于修改模板后直接刷新）
+_PAGE_CACHE = {}
+
+# 浏览器可缓存页面的时长(秒)；过期后凭 ETag 协商，内容未变时返回 304
+PAGE_MAX_AGE = 300
+
+def render_static_page(template_name):
+    """渲染并缓存静态页面，带 ETag / Cache-Control，支持 If-None-Match 返回 304"""
+    page = _PAGE_CACHE.get(template_name)
+    if page is None:
+        body = render_template(template_name).encode('utf-8')
+        page = (body, hashlib.blake2b(body, digest_size=16).hexdigest())
+        if not app.debug:
+            _PAGE_CACHE[template_name] = page
+    
+    body, etag = page
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    if not app.debug:
+        response.cache_control.public = True
+        response.cache_control.max_age = PAGE_MAX_AGE
+    return response.make_conditional(request)
 
 @app.route('/')
 def index():
     """主页路由 - 聊天界面"""
     try:
-        return render_template('chat.html')
+        return render_static_page('chat.html')
     except Exception as e:
         logger.error(f"Error serving index page: {e}")
         return f"Template error: {str(e)}", 500
@@ -68,7 +141,7 @@ def index():
 def login_page():
     """登录页面"""
     try:
-        return render_template('login.html')
+        return render_static_page('login.html')
     except Exception as e:
         logger.error(f"Error serving login page: {e}")
         return f"Template error: {str(e)}", 500
@@ -100,18 +173,19 @@ def login():
         if existing_student:
             redis_db.update_student_login(student_id)
         else:
+            now_iso = datetime.now(timezone.utc).isoformat()
             student_data = {
                 'student_id': student_id,
                 'group_id': group_info['group_id'],
                 'group_name': group_info['group_name'],
                 'llm_type': group_info['llm_type'],
                 'login_count': 1,
-                'first_login_at': datetime.now(timezone.utc).isoformat(),
-                'last_login_at': datetime.now(timezone.utc).isoformat()
+                'first_login_at': now_iso,
+                'last_login_at': now_iso
             }
             redis_db.save_student(student_id, student_data)
         
-        logger.info(f"Student {student_id} logged in")
+        logger.info("Student %s logged in", student_id)
         
         return jsonify({
             'success': True,
@@ -135,15 +209,22 @@ def logout():
     """学生登出"""
     return jsonify({'success': True, 'message': '已登出'})
 
+# 健康检查的各项取值确定后不再变化，首次请求时序列化一次
+# (不在导入时构建：redis_db.available 会触发连接测试，拖慢冷启动)
+_health_bytes = None
+
 @app.route('/health')
 def health_check():
     """健康检查"""
-    return jsonify({
-        'status': 'healthy',
-        'api_configured': bool(API_KEY),
-        'students_loaded': len(STUDENTS_CONFIG.get('groups', {})),
-        'redis_available': redis_db.available
-    })
+    global _health_bytes
+    if _health_bytes is None:
+        _health_bytes = orjson.dumps({
+            'status': 'healthy',
+            'api_configured': _API_KEY_OK,
+            'students_loaded': len(STUDENTS_CONFIG.get('groups', {})),
+            'redis_available': redis_db.available
+        })
+    return app.response_class(_health_bytes, mimetype='application/json')
 
 
 # ================== 人格测试相关路由 ==================
@@ -152,7 +233,7 @@ def health_check():
 def personality_test_page():
     """人格测试页面"""
     try:
-        return render_template('personality_test.html')
+        return render_static_page('personality_test.html')
     except Exception as e:
         logger.error(f"Error serving personality test page: {e}")
         return f"Template error: {str(e)}", 500
@@ -195,7 +276,7 @@ def save_personality_results():
         success = redis_db.save_personality(student_id, personality_data)
         
         if success:
-            logger.info(f"Personality data saved for student {student_id}")
+            logger.info("Personality data saved for student %s", student_id)
             return jsonify({
                 'success': True,
                 'message': '人格测试结果已保存'
@@ -260,47 +341,38 @@ def check_personality_status(student_id):
         }), 500
 
 
+PERSONALITY_EXPORT_FIELDS = [
+    'student_id', 'extraversion', 'agreeableness', 'conscientiousness',
+    'emotional_stability', 'openness', 'language', 'completed_at', 'test_version'
+]
+
+
 @app.route('/api/export/personality', methods=['GET'])
 def export_personality_data():
     """导出所有学生人格测试数据为CSV"""
     try:
-        import pandas as pd
-        from io import BytesIO
-        from flask import send_file
+        def rows():
+            # 展平数据结构
+            for item in redis_db.iter_all_personality_data():
+                scores = item.get('scores', {})
+                yield {
+                    'student_id': item.get('student_id'),
+                    'extraversion': scores.get('extraversion'),
+                    'agreeableness': scores.get('agreeableness'),
+                    'conscientiousness': scores.get('conscientiousness'),
+                    'emotional_stability': scores.get('emotional_stability'),
+                    'openness': scores.get('openness'),
+                    'language': item.get('language'),
+                    'completed_at': item.get('completed_at'),
+                    'test_version': item.get('test_version')
+                }
         
-        personality_data = redis_db.get_all_personality_data()
+        response = stream_csv(rows(), PERSONALITY_EXPORT_FIELDS, 'personality_data')
         
-        if not personality_data:
+        if response is None:
             return jsonify({'error': 'No personality data to export'}), 404
         
-        # 展平数据结构
-        flat_data = []
-        for item in personality_data:
-            flat_item = {
-                'student_id': item.get('student_id'),
-                'extraversion': item.get('scores', {}).get('extraversion'),
-                'agreeableness': item.get('scores', {}).get('agreeableness'),
-                'conscientiousness': item.get('scores', {}).get('conscientiousness'),
-                'emotional_stability': item.get('scores', {}).get('emotional_stability'),
-                'openness': item.get('scores', {}).get('openness'),
-                'language': item.get('language'),
-                'completed_at': item.get('completed_at'),
-                'test_version': item.get('test_version')
-            }
-            flat_data.append(flat_item)
-        
-        df = pd.DataFrame(flat_data)
-        
-        output = BytesIO()
-        df.to_csv(output, index=False, encoding='utf-8-sig')
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'personality_data_{datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")}.csv'
-        )
+        return response
     except Exception as e:
         logger.error(f"Export personality error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -311,6 +383,10 @@ def export_personality_data():
 def chat_stream():
     """处理聊天消息 - 流式输出版本（带中间输出展示）"""
     
+    # 按 Content-Length 拒绝超大请求，不读取、不解析请求体
+    if (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+        return _error_response(_ERR_TOO_LARGE, 413)
+    
     def generate():
         try:
             data = request.get_json()
@@ -319,92 +395,106 @@ def chat_stream():
             student_id = data.get('student_id', 'default')
             llm_type = data.get('llm_type', 'original')
             
-            if not user_message or len(user_message) > 2000:
-                yield f"data: {json.dumps({'type': 'error', 'error': 'Invalid message', 'success': False})}\n\n"
+            if not user_message or len(user_message) > MAX_MESSAGE_LENGTH or _CONTROL_ONLY_RE.match(user_message):
+                yield _SSE_ERR_INVALID_MESSAGE
+                return
+            
+            if not is_valid_session_id(session_id):
+                yield _SSE_ERR_INVALID_SESSION_ID
                 return
             
-            if not API_KEY:
-                yield f"data: {json.dumps({'type': 'error', 'error': 'API configuration error', 'success': False})}\n\n"
+            if not _API_KEY_OK:
+                yield _SSE_ERR_API_CONFIG
                 return
             
-            # 创建新对话（如果需要）
+            # 新对话只生成 ID，拿到回复后随问答一起写入 Redis；
+            # session_id 也等到回复成功后才发给客户端，失败的首轮不会留下不存在的会话 ID
+            new_conversation = None
             if not session_id:
-                session_id = str(uuid.uuid4())
+                session_id = uuid.uuid4().hex
                 group_info = get_student_group(student_id) or {'group_id': 'unknown', 'group_name': 'unknown'}
-                
-                redis_db.create_conversation(
-                    session_id, 
-                    student_id, 
-                    group_info, 
+                new_conversation = (
+                    group_info,
                     llm_type,
                     user_message[:30] + ('...' if len(user_message) > 30 else '')
                 )
-                
-                yield f"data: {json.dumps({'type': 'session_id', 'session_id': session_id})}\n\n"
-            
-            # 获取对话历史
-            conversation = redis_db.get_conversation(session_id)
-            messages = []
-            
-            if conversation and conversation.get('messages'):
-                for msg in conversation['messages'][-20:]:
-                    messages.append({
-                        'role': msg['role'],
-                        'content': msg['content']
-                    })
+                conversation = None
+            else:
+                # 获取对话历史
+                conversation = redis_db.get_conversation(session_id)
+            # 按 token 预算从最新一条往前截取历史
+            messages = trim_history(conversation['messages']) if conversation and conversation.get('messages') else []
             
             if not messages or messages[-1]['role'] != 'user':
                 messages.append({'role': 'user', 'content': user_message})
             
-            logger.info(f"Streaming response for student {student_id}, type: {llm_type}")
+            logger.info("Streaming response for student %s, type: %s", student_id, llm_type)
             
             # ========== 根据 llm_type 路由 ==========
             full_response = ""
+            greeting_reply = get_greeting_reply(user_message)
+            
+            if greeting_reply:
+                # 简单问候：直接返回预设回复，不调用 LLM
+                full_response = greeting_reply
+                yield sse_content(full_response)
             
-            if llm_type == 'original':
+            elif llm_type == 'original':
                 # 对照组：直接流式输出
-                response = call_qwen_api_stream(messages, max_tokens=2000, timeout=60)
-                
-                for line in response.iter_lines():
-                    if line:
-                        line_str = line.decode('utf-8')
-                        
-                        if line_str.startswith('data: '):
-                            json_str = line_str[6:]
-                            
-                            if json_str.strip() == '[DONE]':
-                                break
-                            
-                            try:
-                                chunk_data = json.loads(json_str)
-                                
-                                if 'choices' in chunk_data and len(chunk_data['choices']) > 0:
-                                    delta = chunk_data['choices'][0].get('delta', {})
-                                    content = delta.get('content', '')
-                                    
-                                    if content:
-                                        full_response += content
-                                        yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-                            
-                            except json.JSONDecodeError as e:
-                                logger.warning(f"JSON decode error: {e}")
-                                continue
+                for text in stream_qwen_content(messages, **AGENT_CONFIG['full_response']):
+                    full_response += text
+                    yield sse_content(text)
             
-            elif llm_type == 'srl':
-                # ========== SRL组工作流 ==========
-                import time
-                
-                # 步骤1: 分析问题
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'analyzing', 'message': '💭 正在分析你的问题...'})}\n\n"
-                time.sleep(0.3)
-                yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'analyzing'})}\n\n"
-                
-                # 步骤2: 调用SRL Agent
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'srl_guidance', 'message': '🎯 生成学习指导建议...'})}\n\n"
-                
-                srl_agent_prompt = {
-                    'role': 'system',
-                    'content': '''你是一个自我调节学习(SRL)指导专家。
+            elif llm_type in AGENT_PIPELINES:
+                # 指导 Agent 工作流（SRL / AI Ethics / SRL+Ethics）
+                full_response = yield from stream_agent_pipeline(llm_type, messages, user_message)
+            
+            if not full_response:
+                yield SSE_FRAMES['invalid_response']
+                return
+            
+            # 保存到数据库：回复已全部流给客户端，此时同步写入不影响首字延迟；
+            # 必须在 done 之前完成，客户端收到 done 会立即刷新会话列表，收到后断开连接也不会丢失这一轮问答
+            saved = persist_exchange(session_id, student_id, user_message, full_response, None, new_conversation)
+            
+            if new_conversation is not None and saved:
+                yield sse_event({'type': 'session_id', 'session_id': session_id})
+            
+            # 发送完成信号
+            yield SSE_FRAMES['done']
+            
+        except Exception as e:
+            logger.error(f"Stream error: {e}")
+            yield sse_event({'type': 'error', 'error': str(e), 'success': False})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+# ================== LLM调用接口 ==================
+
+# API 配置常量
+AGENT_CONFIG = {
+    'short_instruction': {
+        'max_tokens': 300,      # Agent 简短指导 (2-3句话)
+        'timeout': 30,
+        'cache': True           # 指导只取决于学生问题，可复用
+    },
+    'full_response': {
+        'max_tokens': 2000,      # 完整回答
+        'timeout': 60
+    }
+}
+
+# ================== Agent 系统提示词 ==================
+# 固定不变，模块加载时构建一次，避免每个请求重新创建字典
+SRL_AGENT_PROMPT = {
+    'role': 'system',
+    'content': '''你是一个自我调节学习(SRL)指导专家。
 
 请分析学生的问题,并提供简短的SRL指导建议(2-3句话),帮助学生:
 - 设定明确的学习目标
@@ -413,88 +503,11 @@ def chat_stream():
 - 提供元认知支持
 
 只需要返回SRL指导建议,不要直接回答学生的问题。'''
-                }
-                
-                srl_agent_messages = [
-                    srl_agent_prompt,
-                    {'role': 'user', 'content': f'学生问题: {user_message}\n\n请给出SRL指导建议:'}
-                ]
-                
-                try:
-                    srl_response = call_qwen_api(srl_agent_messages, **AGENT_CONFIG['short_instruction'])
-                    srl_instruction = srl_response['choices'][0]['message']['content'].strip()
-                    
-                    # 💡 发送SRL指导的中间输出
-                    yield f"data: {json.dumps({
-                        'type': 'intermediate_output',
-                        'step': 'srl_guidance',
-                        'content': srl_instruction,
-                        'label': '💡 SRL学习指导建议'
-                    })}\n\n"
-                    
-                    time.sleep(0.3)
-                    yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'srl_guidance'})}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Error calling SRL agent: {e}")
-                    srl_instruction = "请思考你的学习目标,并在学习过程中监控自己的进度。"
-                
-                # 步骤3: 生成最终回答
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'generating', 'message': '✍️ 整合指导并生成回答...'})}\n\n"
-                time.sleep(0.3)
-                yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'generating'})}\n\n"
-
-                
-                final_system_prompt = {
-                    'role': 'system',
-                    'content': f'''你是一个支持自我调节学习(SRL)的AI助手。
-
-**SRL 指导建议:**
-{srl_instruction}
-
-请在回答学生问题时:
-1. 自然地融入上述SRL指导建议
-2. 提供准确、有帮助的答案
-3. 鼓励学生进行自我反思和监控
-4. 帮助学生"学会如何学习"
+}
 
-记住:你的回答应该既解决学生的具体问题,又促进他们的自我调节学习能力。'''
-                }
-                
-                final_messages = [final_system_prompt]
-                if len(messages) > 1:
-                    for msg in messages[:-1]:
-                        final_messages.append({'role': msg['role'], 'content': msg['content']})
-                final_messages.append({'role': 'user', 'content': user_message})
-                
-                result = call_qwen_api(final_messages, **AGENT_CONFIG['full_response'])
-                
-                if 'choices' in result and result['choices']:
-                    full_response = result['choices'][0]['message']['content'].strip()
-                    time.sleep(0.2)
-                    
-                    chunk_size = 8
-                    for i in range(0, len(full_response), chunk_size):
-                        chunk = full_response[i:i+chunk_size]
-                        yield f"data: {json.dumps({'type': 'content', 'content': chunk})}\n\n"
-                        time.sleep(0.05)
-                else:
-                    yield f"data: {json.dumps({'type': 'error', 'error': 'Invalid API response', 'success': False})}\n\n"
-                    return
-            
-            elif llm_type == 'ai_ethics':
-                # ========== AI Ethics组工作流 ==========
-                import time
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'analyzing', 'message': '💭 正在分析你的问题...'})}\n\n"
-                time.sleep(0.3)
-                yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'analyzing'})}\n\n"
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'ethics_guidance', 'message': '🤔 思考AI伦理要点...'})}\n\n"
-                
-                ethics_agent_prompt = {
-                    'role': 'system',
-                    'content': '''你是一个AI伦理教育专家。
+ETHICS_AGENT_PROMPT = {
+    'role': 'system',
+    'content': '''你是一个AI伦理教育专家。
 
 请分析学生的问题,并提供简短的AI伦理指导建议(2-3句话),帮助学生:
 - 识别AI技术中的潜在偏见和公平性问题
@@ -503,261 +516,183 @@ def chat_stream():
 - 认识AI的社会影响和责任
 
 只需要返回AI伦理指导建议,不要直接回答学生的问题。'''
-                }
-                
-                ethics_agent_messages = [
-                    ethics_agent_prompt,
-                    {'role': 'user', 'content': f'学生问题: {user_message}\n\n请给出AI伦理指导建议:'}
-                ]
-                
-                try:
-                    ethics_response = call_qwen_api(ethics_agent_messages, **AGENT_CONFIG['short_instruction'])
-                    ethics_instruction = ethics_response['choices'][0]['message']['content'].strip()
-                    
-                    yield f"data: {json.dumps({
-                        'type': 'intermediate_output',
-                        'step': 'ethics_guidance',
-                        'content': ethics_instruction,
-                        'label': '🤔 AI伦理思考要点'
-                    })}\n\n"
-                    
-                    time.sleep(0.3)
-                    yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'ethics_guidance'})}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Error calling AI Ethics agent: {e}")
-                    ethics_instruction = "在使用AI技术时,请思考可能存在的偏见和伦理问题,并负责任地使用。"
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'generating', 'message': '✍️ 整合伦理视角并生成回答...'})}\n\n"
-                time.sleep(0.3)
-                yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'generating'})}\n\n"
-                
-                final_system_prompt = {
-                    'role': 'system',
-                    'content': f'''你是一个注重AI伦理教育的AI助手。
+}
+
+# ================== 最终回答的系统提示词 ==================
+# 系统提示词是固定常量，始终作为 messages[0] 原样发送；逐请求变化的指导建议
+# 放在最后一条用户消息里。这样每次请求的前缀(系统提示词 + 只追加的历史)保持一致，
+# 上游可以命中前缀缓存(prompt caching)，减少重复的 prefill 开销。
+FINAL_SYSTEM_PROMPTS = {
+    'srl': {
+        'role': 'system',
+        'content': '''你是一个支持自我调节学习(SRL)的AI助手。
+
+学生的问题前会附带一段 **SRL 指导建议**。
 
-**AI伦理指导建议:**
-{ethics_instruction}
+请在回答学生问题时:
+1. 自然地融入该SRL指导建议
+2. 提供准确、有帮助的答案
+3. 鼓励学生进行自我反思和监控
+4. 帮助学生"学会如何学习"
+
+记住:你的回答应该既解决学生的具体问题,又促进他们的自我调节学习能力。'''
+    },
+    'ai_ethics': {
+        'role': 'system',
+        'content': '''你是一个注重AI伦理教育的AI助手。
+
+学生的问题前会附带一段 **AI伦理指导建议**。
 
 请在回答学生问题时:
-1. 自然地融入上述AI伦理指导建议
+1. 自然地融入该AI伦理指导建议
 2. 提供准确、有帮助的答案
 3. 适时讨论AI技术的伦理问题(偏见、公平性、隐私等)
 4. 鼓励学生批判性地思考AI的使用
 5. 强调负责任地使用AI工具的重要性
 
 记住:你的回答应该既解决学生的具体问题,又培养他们对AI伦理的意识和批判性思维。'''
-                }
-                
-                final_messages = [final_system_prompt]
-                if len(messages) > 1:
-                    for msg in messages[:-1]:
-                        final_messages.append({'role': msg['role'], 'content': msg['content']})
-                final_messages.append({'role': 'user', 'content': user_message})
-                
-                result = call_qwen_api(final_messages, **AGENT_CONFIG['full_response'])
-                
-                if 'choices' in result and result['choices']:
-                    full_response = result['choices'][0]['message']['content'].strip()
-                    time.sleep(0.2)
-                    
-                    chunk_size = 8
-                    for i in range(0, len(full_response), chunk_size):
-                        chunk = full_response[i:i+chunk_size]
-                        yield f"data: {json.dumps({'type': 'content', 'content': chunk})}\n\n"
-                        time.sleep(0.05)
-                else:
-                    yield f"data: {json.dumps({'type': 'error', 'error': 'Invalid API response', 'success': False})}\n\n"
-                    return
-            
-            elif llm_type == 'srl_and_ethics':
-                # ========== SRL+Ethics组工作流 ==========
-                import time
-                
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'analyzing', 'message': '💭 正在分析你的问题...'})}\n\n"
-                time.sleep(0.3)
-                yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'analyzing'})}\n\n"
-                
-                # 第一步: AI Ethics
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'ethics_guidance', 'message': '🤔 思考AI伦理要点...'})}\n\n"
-                
-                ethics_agent_prompt = {
-                    'role': 'system',
-                    'content': '''你是一个AI伦理教育专家。
+    },
+    'srl_and_ethics': {
+        'role': 'system',
+        'content': '''你是一个同时支持自我调节学习(SRL)和AI伦理教育的AI助手。
 
-请分析学生的问题,并提供简短的AI伦理指导建议(2-3句话),帮助学生:
-- 识别AI技术中的潜在偏见和公平性问题
-- 理解数据隐私和安全的重要性
-- 培养对AI使用的批判性思维
-- 认识AI的社会影响和责任
+学生的问题前会附带一段 **整合指导建议(SRL + AI Ethics)**。
 
-只需要返回AI伦理指导建议,不要直接回答学生的问题。'''
-                }
-                
-                ethics_agent_messages = [
-                    ethics_agent_prompt,
-                    {'role': 'user', 'content': f'学生问题: {user_message}\n\n请给出AI伦理指导建议:'}
-                ]
-                
-                try:
-                    ethics_response = call_qwen_api(ethics_agent_messages, **AGENT_CONFIG['short_instruction'])
-                    ethics_instruction = ethics_response['choices'][0]['message']['content'].strip()
-                    
-                    yield f"data: {json.dumps({
-                        'type': 'intermediate_output',
-                        'step': 'ethics_guidance',
-                        'content': ethics_instruction,
-                        'label': '🤔 AI伦理思考要点'
-                    })}\n\n"
-                    
-                    time.sleep(0.3)
-                    yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'ethics_guidance'})}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Error calling AI Ethics agent: {e}")
-                    ethics_instruction = "在使用AI技术时,请思考可能存在的偏见和伦理问题,并负责任地使用。"
-                
-                # 第二步: SRL调整
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'srl_adjustment', 'message': '🎯 调整为学习指导...'})}\n\n"
-                
-                srl_agent_prompt = {
-                    'role': 'system',
-                    'content': '''你是一个自我调节学习(SRL)指导专家。
+请在回答学生问题时:
+1. 自然地融入该整合指导建议
+2. 提供准确、有帮助的答案
+3. **SRL方面**: 鼓励学生设定学习目标、监控进度、反思策略
+4. **AI伦理方面**: 讨论AI的伦理问题、培养批判性思维
+5. 平衡这两个方面,帮助学生成为负责任的、自主的学习者
 
-你将收到一个AI伦理方面的指导建议。请基于SRL原则对这个指导进行调整和扩展,使其:
-- 鼓励学生设定学习目标
-- 引导学生监控和评估自己的理解
-- 促进学生的元认知思考
-- 帮助学生反思学习策略
+记住:你的回答应该既解决学生的具体问题,又同时促进他们的自我调节学习能力和AI伦理意识。'''
+    }
+}
 
-请保留原有的AI伦理内容,但用SRL的视角进行重新表述和扩展(3-4句话)。'''
-                }
-                
-                srl_agent_messages = [
-                    srl_agent_prompt,
-                    {'role': 'user', 'content': f'''学生的原始问题: {user_message}
+GUIDANCE_LABELS = {
+    'srl': 'SRL 指导建议',
+    'ai_ethics': 'AI伦理指导建议',
+    'srl_and_ethics': '整合指导建议(SRL + AI Ethics)'
+}
 
-AI伦理指导建议:
-{ethics_instruction}
 
-请基于SRL原则调整和扩展这个指导:'''}
-                ]
-                
-                try:
-                    srl_response = call_qwen_api(srl_agent_messages, **AGENT_CONFIG['medium_instruction'])
-                    final_instruction = srl_response['choices'][0]['message']['content'].strip()
-                    
-                    yield f"data: {json.dumps({
-                        'type': 'intermediate_output',
-                        'step': 'srl_adjustment',
-                        'content': final_instruction,
-                        'label': '🎯 整合后的学习指导'
-                    })}\n\n"
-                    
-                    time.sleep(0.3)
-                    yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'srl_adjustment'})}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Error calling SRL agent: {e}")
-                    final_instruction = ethics_instruction + " 请在学习过程中监控自己的理解,并反思你的学习策略。"
-                
-                # 第三步: 生成最终回答
-                yield f"data: {json.dumps({'type': 'thinking', 'step': 'generating', 'message': '✍️ 生成最终回答...'})}\n\n"
-                time.sleep(0.3)
-                yield f"data: {json.dumps({'type': 'thinking_complete', 'step': 'generating'})}\n\n"
+def build_final_messages(llm_type, messages, instruction, user_message):
+    """
+    构建最终回答的消息列表: 固定系统提示词 + 历史对话 + 附带指导建议的当前问题
+    
+    messages 的最后一条是当前问题，直接按位置取历史，不再先切片复制一份
+    """
+    final_messages = [FINAL_SYSTEM_PROMPTS[llm_type]]
+    final_messages.extend(islice(messages, len(messages) - 1))
+    final_messages.append({
+        'role': 'user',
+        'content': f"**{GUIDANCE_LABELS[llm_type]}:**\n{instruction}\n\n**学生问题:**\n{user_message}"
+    })
+    return final_messages
+
+# 简单问候语：直接返回预设回复，不调用 LLM
+GREETINGS = frozenset({
+    'hi', 'hello', 'hey', 'hiya', 'greetings', 'how are you',
+    'good morning', 'good afternoon', 'good evening',
+    '你好', '您好', '你好呀', '嗨', '哈喽', '哈啰', '在吗', '老师好',
+    '早上好', '下午好', '晚上好'
+})
+GREETING_REPLIES = (
+    '你好！今天想学习什么内容？可以先说说你的学习目标。',
+    '你好！有什么学习上的问题想一起探讨吗？',
+    '嗨！欢迎提问，说说你现在遇到的问题吧。'
+)
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+
+def get_greeting_reply(user_message):
+    """识别简单问候并返回预设回复；不是问候时返回 None"""
+    if len(user_message) > 30:
+        return None
+    
+    normalized = ' '.join(_PUNCTUATION_RE.sub('', user_message.lower()).split())
+    if normalized in GREETINGS:
+        return random.choice(GREETING_REPLIES)
+    return None
 
-                
-                final_system_prompt = {
-                    'role': 'system',
-                    'content': f'''你是一个同时支持自我调节学习(SRL)和AI伦理教育的AI助手。
+# 发送给模型的历史对话 token 预算与条数上限
+HISTORY_TOKEN_BUDGET = 4000
+HISTORY_MAX_MESSAGES = 20
 
-**整合指导建议(SRL + AI Ethics):**
-{final_instruction}
 
-请在回答学生问题时:
-1. 自然地融入上述整合指导建议
-2. 提供准确、有帮助的答案
-3. **SRL方面**: 鼓励学生设定学习目标、监控进度、反思策略
-4. **AI伦理方面**: 讨论AI的伦理问题、培养批判性思维
-5. 平衡这两个方面,帮助学生成为负责任的、自主的学习者
+def estimate_tokens(text):
+    """粗略估算 token 数（按 UTF-8 字节数/3，中文约一字一 token，英文偏保守）"""
+    return len(text.encode('utf-8')) // 3 + 1
 
-记住:你的回答应该既解决学生的具体问题,又同时促进他们的自我调节学习能力和AI伦理意识。'''
-                }
-                
-                final_messages = [final_system_prompt]
-                if len(messages) > 1:
-                    for msg in messages[:-1]:
-                        final_messages.append({'role': msg['role'], 'content': msg['content']})
-                final_messages.append({'role': 'user', 'content': user_message})
-                
-                result = call_qwen_api(final_messages, **AGENT_CONFIG['full_response'])
-                
-                if 'choices' in result and result['choices']:
-                    full_response = result['choices'][0]['message']['content'].strip()
-                    time.sleep(0.2)
-                    
-                    chunk_size = 8
-                    for i in range(0, len(full_response), chunk_size):
-                        chunk = full_response[i:i+chunk_size]
-                        yield f"data: {json.dumps({'type': 'content', 'content': chunk})}\n\n"
-                        time.sleep(0.05)
-                else:
-                    yield f"data: {json.dumps({'type': 'error', 'error': 'Invalid API response', 'success': False})}\n\n"
-                    return
-            
-            # 发送完成信号
-            yield f"data: {json.dumps({'type': 'done', 'success': True})}\n\n"
-            
-            # 保存到数据库
-            user_word_count = len(user_message.split())
-            ai_word_count = len(full_response.split())
-            
-            redis_db.add_message_to_conversation(session_id, 'user', user_message, user_word_count)
-            redis_db.add_message_to_conversation(session_id, 'assistant', full_response, ai_word_count)
-            redis_db.add_to_student_stats(student_id, 2, 0)  # 2条消息
-            
-        except Exception as e:
-            logger.error(f"Stream error: {e}")
-            yield f"data: {json.dumps({'type': 'error', 'error': str(e), 'success': False})}\n\n"
+
+def trim_history(history, budget=HISTORY_TOKEN_BUDGET, max_messages=HISTORY_MAX_MESSAGES):
+    """
+    从最新一条往前保留历史消息，直到超出 token 预算或条数上限
     
-    return Response(
-        stream_with_context(generate()),
-        mimetype='text/event-stream',
-        headers={
-            'Cache-Control': 'no-cache',
-            'X-Accel-Buffering': 'no'
-        }
-    )
-# ================== LLM调用接口 ==================
+    history 为 Redis 中保存的消息，只取 role/content 组装成发送给模型的消息
+    """
+    kept = []
+    total = 0
+    for msg in reversed(history):
+        tokens = estimate_tokens(msg['content'])
+        if total + tokens > budget or len(kept) >= max_messages:
+            break
+        kept.append({'role': msg['role'], 'content': msg['content']})
+        total += tokens
+    
+    if len(kept) < len(history):
+        logger.info("History trimmed from %s to %s messages (~%s tokens)", len(history), len(kept), total)
+    
+    kept.reverse()
+    return kept
 
-import time
-from requests.exceptions import Timeout, RequestException
+# LLM 响应缓存有效期(秒)
+LLM_CACHE_TTL = 3600
 
-# API 配置常量
-AGENT_CONFIG = {
-    'short_instruction': {
-        'max_tokens': 300,      # Agent 简短指导 (2-3句话)
-        'timeout': 30
-    },
-    'medium_instruction': {
-        'max_tokens': 600,      # Agent 中等指导 (3-5句话)
-        'timeout': 30
-    },
-    'full_response': {
-        'max_tokens': 2000,      # 完整回答
-        'timeout': 60
-    }
+# 流式输出时合并 delta 的时间窗口(秒)
+SSE_FLUSH_INTERVAL = 0.05
+
+# 读取上游流式响应的缓冲大小(字节)；上游为 chunked 编码，每个 HTTP 分块到达即返回，不会等满缓冲
+QWEN_STREAM_READ_SIZE = 8192
+
+# 通义千问请求头（API Key 在运行期间不会变化，只构建一次）
+QWEN_HEADERS = {
+    'Authorization': f'Bearer {API_KEY}',
+    'Content-Type': 'application/json',
+    'Accept-Encoding': 'gzip'
 }
+
+# 全局复用的 HTTP 会话：保持 keep-alive 连接池，避免每次调用都重新进行 TCP+TLS 握手
+QWEN_SESSION = requests.Session()
+QWEN_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    # 只重试网关返回的 502/503/504；连接/读取超时不在这里重试（LLM 调用的 POST 非幂等，
+    # 读超时重发会让上游重复生成），交给 _post_qwen 的 Timeout 分支按退避策略处理
+    max_retries=Retry(
+        total=2,
+        connect=False,
+        read=False,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],  # 429 由 call_qwen_api 在并发闸门外退避重试
+        allowed_methods=frozenset(['POST']),
+        raise_on_status=False
+    )
+))
+
+# 同时进行中的上游请求上限：突发流量时排队等待，而不是一起打到 DashScope 触发 429 重试风暴
+# (gevent worker 下 threading 已被 monkey-patch，信号量只挂起当前协程)
+# 建连超时单独设短：DashScope 不可达时快速失败，不让 worker 空等整个读超时
+QWEN_CONNECT_TIMEOUT = 5
+
+QWEN_MAX_INFLIGHT = int(os.environ.get('QWEN_MAX_INFLIGHT', 16))
+QWEN_SEMAPHORE = threading.BoundedSemaphore(QWEN_MAX_INFLIGHT)
+
 # 修改通义千问 API 调用，支持流式输出
 def call_qwen_api_stream(messages, max_tokens=800, timeout=60):
     """
     调用通义千问API - 流式版本
     """
-    headers = {
-        'Authorization': f'Bearer {API_KEY}',
-        'Content-Type': 'application/json'
-    }
-    
     api_data = {
         'model': 'qwen-plus',
         'messages': messages,
@@ -768,36 +703,112 @@ def call_qwen_api_stream(messages, max_tokens=800, timeout=60):
     }
     
     try:
-        response = requests.post(
-            API_BASE_URL, 
-            headers=headers, 
-            json=api_data, 
-            stream=True,  # 👈 流式接收
-            timeout=timeout
-        )
-        response.raise_for_status()
+        # 只在建立连接、等待响应头期间占用名额，流式读取正文时不占用
+        with QWEN_SEMAPHORE:
+            response = QWEN_SESSION.post(
+                API_BASE_URL, 
+                headers=QWEN_HEADERS, 
+                data=orjson.dumps(api_data), 
+                stream=True,  # 👈 流式接收
+                timeout=(QWEN_CONNECT_TIMEOUT, timeout)
+            )
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
         return response
     except Exception as e:
         logger.error(f"API stream error: {e}")
         raise
-def call_qwen_api(messages, max_tokens=800, timeout=60, max_retries=2):
+
+def stream_qwen_content(messages, max_tokens=2000, timeout=60):
+    """
+    流式调用通义千问，逐段产出回答文本
+    
+    上游每个 delta 往往只有一两个字，按时间窗口合并后再产出，减少 SSE 帧数
+    (last_flush 从 0 开始，保证第一段立即发出)
+    """
+    response = call_qwen_api_stream(messages, max_tokens=max_tokens, timeout=timeout)
+    pending = []
+    last_flush = 0.0
+    
+    # 读完、出错或客户端断开时都关闭响应，及时归还连接池中的连接
+    with response:
+        for line in response.iter_lines(chunk_size=QWEN_STREAM_READ_SIZE):
+            if not line.startswith(b'data: '):
+                continue
+            
+            payload = line[6:]
+            if payload.strip() == b'[DONE]':
+                break
+            
+            try:
+                chunk_data = orjson.loads(payload)
+            except orjson.JSONDecodeError as e:
+                logger.warning(f"JSON decode error: {e}")
+                continue
+            
+            choices = chunk_data.get('choices')
+            if not choices:
+                continue
+            
+            content = choices[0].get('delta', {}).get('content')
+            if content:
+                pending.append(content)
+                now = time.monotonic()
+                if now - last_flush >= SSE_FLUSH_INTERVAL:
+                    yield ''.join(pending)
+                    pending.clear()
+                    last_flush = now
+    
+    if pending:
+        yield ''.join(pending)
+
+# ================== 相同请求合并 ==================
+# 开启缓存的 Agent 调用在缓存未命中时，同一时刻到达的相同请求只向上游发送一次，
+# 其余请求等待并复用结果（缓存只能合并先后到达的请求，这里合并同时到达的请求）
+
+class _InflightCall:
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+_INFLIGHT_LOCK = threading.Lock()
+_INFLIGHT_CALLS = {}
+
+
+def _join_inflight(key):
+    """返回 (进行中的调用, 是否由当前请求负责发起)"""
+    with _INFLIGHT_LOCK:
+        call = _INFLIGHT_CALLS.get(key)
+        if call is not None:
+            return call, False
+        call = _INFLIGHT_CALLS[key] = _InflightCall()
+        return call, True
+
+
+def _leave_inflight(key, call):
+    with _INFLIGHT_LOCK:
+        _INFLIGHT_CALLS.pop(key, None)
+    call.event.set()
+
+
+def call_qwen_api(messages, max_tokens=800, timeout=60, max_retries=2, cache=False):
     """
     调用通义千问API (优化版)
     
     Args:
         messages: 消息列表
         max_tokens: 最大生成token数
-        timeout: 超时时间(秒)
+        timeout: 读超时时间(秒)，建连超时固定为 QWEN_CONNECT_TIMEOUT
         max_retries: 最大重试次数
+        cache: 是否使用 Redis 响应缓存（请求体完全相同时直接返回缓存结果）
     
     Returns:
         API响应的JSON对象
     """
-    headers = {
-        'Authorization': f'Bearer {API_KEY}',
-        'Content-Type': 'application/json'
-    }
-    
     api_data = {
         'model': 'qwen-plus',
         'messages': messages,
@@ -806,26 +817,78 @@ def call_qwen_api(messages, max_tokens=800, timeout=60, max_retries=2):
         'top_p': 0.9
     }
     
+    cache_key = None
+    if cache:
+        cache_key = hashlib.sha256(orjson.dumps(api_data, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        cached = redis_db.get_cached_response(cache_key)
+        if cached:
+            logger.info("LLM cache hit: %s", cache_key[:12])
+            return cached
+    
+    # 相同请求正在进行中时，等待其结果而不是重复请求上游
+    inflight = None
+    if cache_key:
+        inflight, is_leader = _join_inflight(cache_key)
+        if not is_leader:
+            if inflight.event.wait(timeout) and inflight.result is not None:
+                logger.info("LLM request coalesced: %s", cache_key[:12])
+                return inflight.result
+            # 先发起的请求失败或超时，自己重新请求
+            inflight = None
+    
+    try:
+        # 只序列化一次（orjson 直接输出 UTF-8 bytes），重试时复用
+        result = _post_qwen(orjson.dumps(api_data), cache_key, max_tokens, timeout, max_retries)
+        if inflight:
+            inflight.result = result
+        return result
+    finally:
+        if inflight:
+            _leave_inflight(cache_key, inflight)
+
+
+def _post_qwen(request_body, cache_key, max_tokens, timeout, max_retries):
+    """发送非流式请求（含 429/超时重试），成功时写入响应缓存"""
     last_error = None
     
     for attempt in range(max_retries):
         try:
-            response = requests.post(
-                API_BASE_URL, 
-                headers=headers, 
-                json=api_data, 
-                timeout=timeout
-            )
+            with QWEN_SEMAPHORE:
+                response = QWEN_SESSION.post(
+                    API_BASE_URL, 
+                    headers=QWEN_HEADERS, 
+                    data=request_body, 
+                    timeout=(QWEN_CONNECT_TIMEOUT, timeout)
+                )
+            
+            # 被限流时释放名额后再退避重试（带随机抖动，避免所有请求同时重试）
+            if response.status_code == 429 and attempt < max_retries - 1:
+                sleep_time = 0.5 * 2 ** attempt + random.random() * 0.1
+                logger.warning(f"API rate limited (429), retrying in {sleep_time:.2f}s")
+                time.sleep(sleep_time)
+                continue
+            
             response.raise_for_status()
             
-            result = response.json()
+            result = orjson.loads(response.content)
             
             # 检查是否因为 max_tokens 限制而截断
+            truncated = False
             if result.get('choices'):
                 finish_reason = result['choices'][0].get('finish_reason')
                 if finish_reason == 'length':
+                    truncated = True
                     logger.warning(f"⚠️ Response truncated due to max_tokens={max_tokens} limit")
             
+            # DashScope 会对相同前缀（固定的 system prompt）自动做上下文缓存，记录命中情况便于观察
+            usage = result.get('usage') or {}
+            cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+            if cached_tokens:
+                logger.info("Prompt prefix cache hit: %s/%s tokens", cached_tokens, usage.get('prompt_tokens'))
+            
+            if cache_key and result.get('choices') and not truncated:
+                redis_db.cache_response(cache_key, result, ex=LLM_CACHE_TTL)
+            
             return result
             
         except Timeout as e:
@@ -833,7 +896,7 @@ def call_qwen_api(messages, max_tokens=800, timeout=60, max_retries=2):
             logger.warning(f"API timeout on attempt {attempt + 1}/{max_retries} (timeout={timeout}s)")
             if attempt < max_retries - 1:
                 sleep_time = 2 ** attempt  # 指数退避: 1s, 2s
-                logger.info(f"Retrying in {sleep_time}s...")
+                logger.info("Retrying in %ss...", sleep_time)
                 time.sleep(sleep_time)
                 continue
             else:
@@ -849,6 +912,114 @@ def call_qwen_api(messages, max_tokens=800, timeout=60, max_retries=2):
     raise last_error
 
 
+# ================== Instruction Agents ==================
+# 流式(/chat/stream)与非流式(/chat)两条路径共用的 Agent 调用
+
+# 并行执行 Agent 调用的线程池（gevent worker 下为协程）
+AGENT_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='agent')
+
+# Agent 调用失败时使用的默认指导
+DEFAULT_SRL_INSTRUCTION = "请思考你的学习目标,并在学习过程中监控自己的进度。"
+DEFAULT_ETHICS_INSTRUCTION = "在使用AI技术时,请思考可能存在的偏见和伦理问题,并负责任地使用。"
+
+# 流式输出中各 Agent 中间结果的展示标题
+AGENT_STEP_LABELS = {
+    'srl_guidance': '💡 SRL学习指导建议',
+    'ethics_guidance': '🤔 AI伦理思考要点'
+}
+
+
+def _call_instruction_agent(agent_prompt, user_content, config_key, agent_name):
+    """调用 Instruction Agent，返回指导文本；失败时返回 None"""
+    try:
+        response = call_qwen_api(
+            [agent_prompt, {'role': 'user', 'content': user_content}],
+            **AGENT_CONFIG[config_key]
+        )
+        instruction = response['choices'][0]['message']['content'].strip()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("%s instruction generated: %s...", agent_name, instruction[:100])
+        return instruction
+    except Exception as e:
+        logger.error(f"Error calling {agent_name} agent: {e}")
+        return None
+
+
+def generate_srl_instruction(user_message):
+    """SRL Agent: 根据学生问题生成 SRL 指导建议"""
+    return _call_instruction_agent(
+        SRL_AGENT_PROMPT,
+        f'学生问题: {user_message}\n\n请给出SRL指导建议:',
+        'short_instruction',
+        'SRL'
+    )
+
+
+def generate_ethics_instruction(user_message):
+    """AI Ethics Agent: 根据学生问题生成 AI 伦理指导建议"""
+    return _call_instruction_agent(
+        ETHICS_AGENT_PROMPT,
+        f'学生问题: {user_message}\n\n请给出AI伦理指导建议:',
+        'short_instruction',
+        'AI Ethics'
+    )
+
+
+def generate_parallel_srl_and_ethics(user_message):
+    """
+    并行调用 AI Ethics Agent 与 SRL Agent（两者都只依赖学生问题），
+    失败的一方使用默认指导
+    
+    Returns:
+        (ethics_instruction, srl_instruction)
+    """
+    ethics_future = AGENT_EXECUTOR.submit(generate_ethics_instruction, user_message)
+    srl_instruction = generate_srl_instruction(user_message) or DEFAULT_SRL_INSTRUCTION
+    ethics_instruction = ethics_future.result() or DEFAULT_ETHICS_INSTRUCTION
+    return ethics_instruction, srl_instruction
+
+
+def merge_srl_and_ethics(ethics_instruction, srl_instruction):
+    """在本地合并两份指导（不再额外调用 LLM）"""
+    return f"AI伦理指导:\n{ethics_instruction}\n\nSRL指导:\n{srl_instruction}"
+
+
+# 指导 Agent 步骤: step -> (生成函数, 失败时的默认指导)
+AGENT_STEPS = MappingProxyType({
+    'srl_guidance': (generate_srl_instruction, DEFAULT_SRL_INSTRUCTION),
+    'ethics_guidance': (generate_ethics_instruction, DEFAULT_ETHICS_INSTRUCTION)
+})
+
+# 各组的流式工作流: 执行的 Agent 步骤、生成回答阶段的提示帧、多份指导的合并方式
+AGENT_PIPELINES = MappingProxyType({
+    'srl': {
+        'steps': ('srl_guidance',),
+        'generating_frame': 'generating_srl'
+    },
+    'ai_ethics': {
+        'steps': ('ethics_guidance',),
+        'generating_frame': 'generating_ethics'
+    },
+    'srl_and_ethics': {
+        'steps': ('ethics_guidance', 'srl_guidance'),
+        'generating_frame': 'generating_final',
+        'merge': merge_srl_and_ethics
+    }
+})
+
+
+def iter_agent_instructions(steps, user_message):
+    """执行各指导 Agent，按完成顺序产出 (step, instruction)；多个 Agent 时并行执行"""
+    if len(steps) == 1:
+        step = steps[0]
+        yield step, AGENT_STEPS[step][0](user_message)
+        return
+    
+    futures = {AGENT_EXECUTOR.submit(AGENT_STEPS[step][0], user_message): step for step in steps}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
 def call_srl_llm(messages, student_id):
     """
     Group 1: SRL辅助的LLM - 两步工作流
@@ -865,73 +1036,15 @@ def call_srl_llm(messages, student_id):
         return call_qwen_api(messages, **AGENT_CONFIG['full_response'])
     
     # ========== 步骤1: 调用 SRL Instruction Agent ==========
-    srl_agent_prompt = {
-        'role': 'system',
-        'content': '''你是一个自我调节学习(SRL)指导专家。
-
-请分析学生的问题,并提供简短的SRL指导建议(2-3句话),帮助学生:
-- 设定明确的学习目标
-- 监控学习进度
-- 反思学习策略
-- 提供元认知支持
-
-只需要返回SRL指导建议,不要直接回答学生的问题。'''
-    }
-    
-    srl_agent_messages = [
-        srl_agent_prompt,
-        {'role': 'user', 'content': f'学生问题: {user_message}\n\n请给出SRL指导建议:'}
-    ]
+    logger.info("Step 1: Calling SRL Instruction Agent for student %s", student_id)
     
-    logger.info(f"Step 1: Calling SRL Instruction Agent for student {student_id}")
-    
-    try:
-        srl_response = call_qwen_api(
-            srl_agent_messages, 
-            **AGENT_CONFIG['short_instruction']  # max_tokens=300, timeout=30
-        )
-        srl_instruction = srl_response['choices'][0]['message']['content'].strip()
-        logger.info(f"SRL Instruction generated: {srl_instruction[:100]}...")
-    except Exception as e:
-        logger.error(f"Error calling SRL agent: {e}")
-        # 如果 SRL agent 失败,使用默认指导
-        srl_instruction = "请思考你的学习目标,并在学习过程中监控自己的进度。"
+    # 如果 SRL agent 失败,使用默认指导
+    srl_instruction = generate_srl_instruction(user_message) or DEFAULT_SRL_INSTRUCTION
     
     # ========== 步骤2: 调用最终 LLM 回答学生问题 ==========
-    final_system_prompt = {
-        'role': 'system',
-        'content': f'''你是一个支持自我调节学习(SRL)的AI助手。
-
-**SRL 指导建议:**
-{srl_instruction}
-
-请在回答学生问题时:
-1. 自然地融入上述SRL指导建议
-2. 提供准确、有帮助的答案
-3. 鼓励学生进行自我反思和监控
-4. 帮助学生"学会如何学习"
-
-记住:你的回答应该既解决学生的具体问题,又促进他们的自我调节学习能力。'''
-    }
+    final_messages = build_final_messages('srl', messages, srl_instruction, user_message)
     
-    # 构建最终的消息列表
-    final_messages = [final_system_prompt]
-    
-    # 添加历史对话(排除最后一条,因为我们要重新添加)
-    if len(messages) > 1:
-        for msg in messages[:-1]:
-            final_messages.append({
-                'role': msg['role'],
-                'content': msg['content']
-            })
-    
-    # 添加当前用户问题
-    final_messages.append({
-        'role': 'user',
-        'content': user_message
-    })
-    
-    logger.info(f"Step 2: Calling final LLM with SRL guidance for student {student_id}")
+    logger.info("Step 2: Calling final LLM with SRL guidance for student %s", student_id)
     
     return call_qwen_api(
         final_messages, 
@@ -955,75 +1068,15 @@ def call_ai_ethics_llm(messages, student_id):
         return call_qwen_api(messages, **AGENT_CONFIG['full_response'])
     
     # ========== 步骤1: 调用 AI Ethics Instruction Agent ==========
-    ethics_agent_prompt = {
-        'role': 'system',
-        'content': '''你是一个AI伦理教育专家。
-
-请分析学生的问题,并提供简短的AI伦理指导建议(2-3句话),帮助学生:
-- 识别AI技术中的潜在偏见和公平性问题
-- 理解数据隐私和安全的重要性
-- 培养对AI使用的批判性思维
-- 认识AI的社会影响和责任
-
-只需要返回AI伦理指导建议,不要直接回答学生的问题。'''
-    }
-    
-    ethics_agent_messages = [
-        ethics_agent_prompt,
-        {'role': 'user', 'content': f'学生问题: {user_message}\n\n请给出AI伦理指导建议:'}
-    ]
+    logger.info("Step 1: Calling AI Ethics Instruction Agent for student %s", student_id)
     
-    logger.info(f"Step 1: Calling AI Ethics Instruction Agent for student {student_id}")
-    
-    try:
-        ethics_response = call_qwen_api(
-            ethics_agent_messages, 
-            **AGENT_CONFIG['short_instruction']  # max_tokens=300, timeout=30
-        )
-        ethics_instruction = ethics_response['choices'][0]['message']['content'].strip()
-        logger.info(f"AI Ethics Instruction generated: {ethics_instruction[:100]}...")
-    except Exception as e:
-        logger.error(f"Error calling AI Ethics agent: {e}")
-        # 如果 AI Ethics agent 失败,使用默认指导
-        ethics_instruction = "在使用AI技术时,请思考可能存在的偏见和伦理问题,并负责任地使用。"
+    # 如果 AI Ethics agent 失败,使用默认指导
+    ethics_instruction = generate_ethics_instruction(user_message) or DEFAULT_ETHICS_INSTRUCTION
     
     # ========== 步骤2: 调用最终 LLM 回答学生问题 ==========
-    final_system_prompt = {
-        'role': 'system',
-        'content': f'''你是一个注重AI伦理教育的AI助手。
-
-**AI伦理指导建议:**
-{ethics_instruction}
-
-请在回答学生问题时:
-1. 自然地融入上述AI伦理指导建议
-2. 提供准确、有帮助的答案
-3. 适时讨论AI技术的伦理问题(偏见、公平性、隐私等)
-4. 鼓励学生批判性地思考AI的使用
-5. 强调负责任地使用AI工具的重要性
-6. 帮助学生理解AI的局限性和潜在风险
-
-记住:你的回答应该既解决学生的具体问题,又培养他们对AI伦理的意识和批判性思维。'''
-    }
-    
-    # 构建最终的消息列表
-    final_messages = [final_system_prompt]
+    final_messages = build_final_messages('ai_ethics', messages, ethics_instruction, user_message)
     
-    # 添加历史对话(排除最后一条,因为我们要重新添加)
-    if len(messages) > 1:
-        for msg in messages[:-1]:
-            final_messages.append({
-                'role': msg['role'],
-                'content': msg['content']
-            })
-    
-    # 添加当前用户问题
-    final_messages.append({
-        'role': 'user',
-        'content': user_message
-    })
-    
-    logger.info(f"Step 2: Calling final LLM with AI Ethics guidance for student {student_id}")
+    logger.info("Step 2: Calling final LLM with AI Ethics guidance for student %s", student_id)
     
     return call_qwen_api(
         final_messages, 
@@ -1033,12 +1086,14 @@ def call_ai_ethics_llm(messages, student_id):
 
 def call_srl_and_ethics_llm(messages, student_id):
     """
-    Group 3: SRL + AI Ethics 双重辅助的LLM - 三步级联工作流
+    Group 3: SRL + AI Ethics 双重辅助的LLM
     
     工作流程:
-    1. 先将学生问题发送给 AI Ethics Instruction Agent,获取AI伦理指导
-    2. 将 AI Ethics 指导发送给 SRL Instruction Agent,进行SRL调整
-    3. 将最终整合的指导 + 学生原始问题一起发送给最终 LLM
+    1. 同时调用 AI Ethics Instruction Agent 和 SRL Instruction Agent（两者只依赖学生问题）
+    2. 在本地合并两份指导
+    3. 将整合的指导 + 学生原始问题一起发送给最终 LLM
+    
+    关键路径上只有两次串行 LLM 调用
     """
     
     # 提取学生的最新问题
@@ -1047,215 +1102,288 @@ def call_srl_and_ethics_llm(messages, student_id):
     if not user_message:
         return call_qwen_api(messages, **AGENT_CONFIG['full_response'])
     
-    # ========== 步骤1: 调用 AI Ethics Instruction Agent ==========
-    ethics_agent_prompt = {
-        'role': 'system',
-        'content': '''你是一个AI伦理教育专家。
-
-请分析学生的问题,并提供简短的AI伦理指导建议(2-3句话),帮助学生:
-- 识别AI技术中的潜在偏见和公平性问题
-- 理解数据隐私和安全的重要性
-- 培养对AI使用的批判性思维
-- 认识AI的社会影响和责任
-
-只需要返回AI伦理指导建议,不要直接回答学生的问题。'''
-    }
+    # ========== 步骤1: 并行调用 AI Ethics 与 SRL Instruction Agent ==========
+    logger.info("Step 1: Calling AI Ethics and SRL Instruction Agents in parallel for student %s", student_id)
     
-    ethics_agent_messages = [
-        ethics_agent_prompt,
-        {'role': 'user', 'content': f'学生问题: {user_message}\n\n请给出AI伦理指导建议:'}
-    ]
+    ethics_instruction, srl_instruction = generate_parallel_srl_and_ethics(user_message)
     
-    logger.info(f"Step 1: Calling AI Ethics Instruction Agent for student {student_id}")
+    # ========== 步骤2: 本地合并指导 ==========
+    final_instruction = merge_srl_and_ethics(ethics_instruction, srl_instruction)
     
-    try:
-        ethics_response = call_qwen_api(
-            ethics_agent_messages, 
-            **AGENT_CONFIG['short_instruction']  # max_tokens=300, timeout=30
-        )
-        ethics_instruction = ethics_response['choices'][0]['message']['content'].strip()
-        logger.info(f"AI Ethics Instruction generated: {ethics_instruction[:100]}...")
-    except Exception as e:
-        logger.error(f"Error calling AI Ethics agent: {e}")
-        # 如果失败,使用默认指导
-        ethics_instruction = "在使用AI技术时,请思考可能存在的偏见和伦理问题,并负责任地使用。"
+    # ========== 步骤3: 调用最终 LLM 回答学生问题 ==========
+    final_messages = build_final_messages('srl_and_ethics', messages, final_instruction, user_message)
     
-    # ========== 步骤2: 调用 SRL Instruction Agent 对伦理指导进行调整 ==========
-    srl_agent_prompt = {
-        'role': 'system',
-        'content': '''你是一个自我调节学习(SRL)指导专家。
+    logger.info("Step 3: Calling final LLM with integrated SRL+Ethics guidance for student %s", student_id)
+    
+    return call_qwen_api(
+        final_messages, 
+        **AGENT_CONFIG['full_response']  # max_tokens=800, timeout=60
+    )
 
-你将收到一个AI伦理方面的指导建议。请基于SRL原则对这个指导进行调整和扩展,使其:
-- 鼓励学生设定学习目标
-- 引导学生监控和评估自己的理解
-- 促进学生的元认知思考
-- 帮助学生反思学习策略
 
-请保留原有的AI伦理内容,但用SRL的视角进行重新表述和扩展(3-4句话)。'''
-    }
-    
-    srl_agent_messages = [
-        srl_agent_prompt,
-        {'role': 'user', 'content': f'''学生的原始问题: {user_message}
+def call_original_llm(messages, student_id):
+    """
+    Group 4: 原始LLM（对照组）
+    不添加任何特殊的系统提示词
+    """
+    return call_qwen_api(messages, **AGENT_CONFIG['full_response'])
 
-AI伦理指导建议:
-{ethics_instruction}
 
-请基于SRL原则调整和扩展这个指导:'''}
-    ]
-    
-    logger.info(f"Step 2: Calling SRL Instruction Agent to adjust ethics guidance for student {student_id}")
+# llm_type -> 处理函数，模块加载时构建一次（只读，防止运行期被意外修改）
+LLM_HANDLERS = MappingProxyType({
+    'srl': call_srl_llm,
+    'ai_ethics': call_ai_ethics_llm,
+    'srl_and_ethics': call_srl_and_ethics_llm,
+    'original': call_original_llm
+})
+
+
+def route_llm_call(llm_type, messages, student_id):
+    """根据组类型路由到对应的LLM调用函数"""
+    handler = LLM_HANDLERS.get(llm_type, call_original_llm)
+    return handler(messages, student_id)
+
+# ================== 聊天接口 ==================
+
+def persist_exchange(session_id, student_id, user_message, ai_reply, usage=None, new_conversation=None):
+    """
+    保存一轮问答并更新学生统计（usage 为模型返回的 token 用量）
     
+    new_conversation 为 (group_info, llm_type, title) 时先创建对话：
+    新对话延迟到拿到回复后才写入，LLM 调用失败不会留下空会话；返回是否写入成功
+    """
+    usage = usage or {}
     try:
-        srl_response = call_qwen_api(
-            srl_agent_messages, 
-            **AGENT_CONFIG['medium_instruction']  # max_tokens=400, timeout=30
+        if new_conversation is not None:
+            group_info, llm_type, title = new_conversation
+            if not redis_db.create_conversation(session_id, student_id, group_info, llm_type, title):
+                return False
+            logger.info("Conversation %s created", session_id)
+        return redis_db.record_exchange(
+            session_id, student_id,
+            user_message, len(user_message.split()),
+            ai_reply, len(ai_reply.split()),
+            prompt_tokens=usage.get('prompt_tokens', 0),
+            completion_tokens=usage.get('completion_tokens', 0)
         )
-        final_instruction = srl_response['choices'][0]['message']['content'].strip()
-        logger.info(f"Final SRL-adjusted instruction generated: {final_instruction[:100]}...")
     except Exception as e:
-        logger.error(f"Error calling SRL agent: {e}")
-        # 如果SRL调整失败,使用原始的伦理指导
-        final_instruction = ethics_instruction + " 请在学习过程中监控自己的理解,并反思你的学习策略。"
-    
-    # ========== 步骤3: 调用最终 LLM 回答学生问题 ==========
-    final_system_prompt = {
-        'role': 'system',
-        'content': f'''你是一个同时支持自我调节学习(SRL)和AI伦理教育的AI助手。
+        logger.error(f"Error persisting exchange for {session_id}: {e}")
+        return False
 
-**整合指导建议(SRL + AI Ethics):**
-{final_instruction}
+MAX_MESSAGE_LENGTH = 2000
 
-请在回答学生问题时:
-1. 自然地融入上述整合指导建议
-2. 提供准确、有帮助的答案
-3. **SRL方面**: 鼓励学生设定学习目标、监控进度、反思策略、提供元认知支持
-4. **AI伦理方面**: 讨论AI的伦理问题(偏见、公平性、隐私)、培养批判性思维、强调负责任使用
-5. 平衡这两个方面,帮助学生成为负责任的、自主的学习者
+# 只包含空白/控制字符的消息
+_CONTROL_ONLY_RE = re.compile(r'\A[\s\x00-\x1f\x7f]*\Z')
 
-记住:你的回答应该既解决学生的具体问题,又同时促进他们的自我调节学习能力和AI伦理意识。'''
-    }
+# 会话 ID：uuid4().hex，兼容早期带连字符的格式；格式不对的直接拒绝，不去查 Redis
+_SESSION_ID_RE = re.compile(r'\A(?:[0-9a-f]{32}|[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})\Z')
+
+# 预先序列化的错误响应体，校验失败时直接返回，无需每次 jsonify
+_ERR_NOT_JSON = b'{"error":"Content-Type must be application/json","success":false}'
+_ERR_TOO_LARGE = b'{"error":"Request body too large","success":false}'
+_ERR_INVALID_JSON = b'{"error":"Invalid JSON","success":false}'
+_ERR_INVALID_MESSAGE = b'{"error":"Invalid message","success":false}'
+_ERR_INVALID_LLM_TYPE = b'{"error":"Invalid llm_type","success":false}'
+_ERR_INVALID_SESSION_ID = b'{"error":"Invalid session_id","success":false}'
+_ERR_API_CONFIG = b'{"error":"API configuration error","success":false}'
+
+_SSE_ERR_INVALID_MESSAGE = b'data: {"type":"error","error":"Invalid message","success":false}\n\n'
+_SSE_ERR_API_CONFIG = b'data: {"type":"error","error":"API configuration error","success":false}\n\n'
+_SSE_ERR_INVALID_SESSION_ID = b'data: {"type":"error","error":"Invalid session_id","success":false}\n\n'
+
+
+def is_valid_session_id(session_id):
+    """会话 ID 为空(新对话)或格式正确"""
+    return not session_id or (isinstance(session_id, str) and _SESSION_ID_RE.match(session_id) is not None)
+
+
+def sse_event(event):
+    """把事件编码为一帧 SSE（orjson 直接输出 bytes，不经过 str）"""
+    return b'data: ' + orjson.dumps(event) + b'\n\n'
+
+
+# 回答内容帧的固定前后缀：每段文本只需编码字符串本身，不必构建事件字典
+_SSE_CONTENT_PREFIX = b'data: {"type":"content","content":'
+_SSE_CONTENT_SUFFIX = b'}\n\n'
+
+
+def sse_content(text):
+    """回答内容帧（与 sse_event({'type': 'content', 'content': text}) 输出相同）"""
+    return _SSE_CONTENT_PREFIX + orjson.dumps(text) + _SSE_CONTENT_SUFFIX
+
+
+# 内容固定的 SSE 帧（思考步骤提示、完成信号等），模块加载时编码一次
+SSE_FRAMES = {
+    'analyzing': sse_event({'type': 'thinking', 'step': 'analyzing', 'message': '💭 正在分析你的问题...'}),
+    'srl_guidance': sse_event({'type': 'thinking', 'step': 'srl_guidance', 'message': '🎯 生成学习指导建议...'}),
+    'ethics_guidance': sse_event({'type': 'thinking', 'step': 'ethics_guidance', 'message': '🤔 思考AI伦理要点...'}),
+    'generating_srl': sse_event({'type': 'thinking', 'step': 'generating', 'message': '✍️ 整合指导并生成回答...'}),
+    'generating_ethics': sse_event({'type': 'thinking', 'step': 'generating', 'message': '✍️ 整合伦理视角并生成回答...'}),
+    'generating_final': sse_event({'type': 'thinking', 'step': 'generating', 'message': '✍️ 生成最终回答...'}),
+    'done': sse_event({'type': 'done', 'success': True}),
+    'invalid_response': sse_event({'type': 'error', 'error': 'Invalid API response', 'success': False})
+}
+
+# 各步骤的完成信号
+SSE_STEP_COMPLETE = {
+    step: sse_event({'type': 'thinking_complete', 'step': step})
+    for step in ('analyzing', 'srl_guidance', 'ethics_guidance', 'generating')
+}
+
+
+def stream_agent_pipeline(llm_type, messages, user_message):
+    """
+    按 AGENT_PIPELINES 执行指导 Agent 工作流，并流式输出最终回答
+    
+    产出 SSE 帧；返回完整回答文本（调用方通过 yield from 取得）
+    """
+    pipeline = AGENT_PIPELINES[llm_type]
+    steps = pipeline['steps']
     
-    # 构建最终的消息列表
-    final_messages = [final_system_prompt]
+    # 步骤1: 分析问题
+    yield SSE_FRAMES['analyzing']
+    yield SSE_STEP_COMPLETE['analyzing']
     
-    # 添加历史对话(排除最后一条,因为我们要重新添加)
-    if len(messages) > 1:
-        for msg in messages[:-1]:
-            final_messages.append({
-                'role': msg['role'],
-                'content': msg['content']
+    # 步骤2: 调用指导 Agent，中间结果按完成顺序展示
+    for step in steps:
+        yield SSE_FRAMES[step]
+    
+    instructions = {}
+    for step, instruction in iter_agent_instructions(steps, user_message):
+        if instruction:
+            yield sse_event({
+                'type': 'intermediate_output',
+                'step': step,
+                'content': instruction,
+                'label': AGENT_STEP_LABELS[step]
             })
+            yield SSE_STEP_COMPLETE[step]
+        else:
+            instruction = AGENT_STEPS[step][1]
+        instructions[step] = instruction
     
-    # 添加当前用户问题
-    final_messages.append({
-        'role': 'user',
-        'content': user_message
-    })
+    merge = pipeline.get('merge')
+    if merge:
+        final_instruction = merge(*(instructions[step] for step in steps))
+    else:
+        final_instruction = instructions[steps[0]]
     
-    logger.info(f"Step 3: Calling final LLM with integrated SRL+Ethics guidance for student {student_id}")
+    # 步骤3: 生成最终回答，直接流式转发
+    yield SSE_FRAMES[pipeline['generating_frame']]
+    yield SSE_STEP_COMPLETE['generating']
     
-    return call_qwen_api(
-        final_messages, 
-        **AGENT_CONFIG['full_response']  # max_tokens=800, timeout=60
-    )
+    final_messages = build_final_messages(llm_type, messages, final_instruction, user_message)
+    
+    full_response = ""
+    for text in stream_qwen_content(final_messages, **AGENT_CONFIG['full_response']):
+        full_response += text
+        yield sse_content(text)
+    return full_response
 
 
-def call_original_llm(messages, student_id):
-    """
-    Group 4: 原始LLM（对照组）
-    不添加任何特殊的系统提示词
-    """
-    return call_qwen_api(messages, **AGENT_CONFIG['full_response'])
+def _error_response(body, status):
+    return app.response_class(body, status=status, mimetype='application/json')
 
 
-def route_llm_call(llm_type, messages, student_id):
-    """根据组类型路由到对应的LLM调用函数"""
-    llm_handlers = {
-        'srl': call_srl_llm,
-        'ai_ethics': call_ai_ethics_llm,
-        'srl_and_ethics': call_srl_and_ethics_llm,
-        'original': call_original_llm
-    }
+def validate_chat_request():
+    """
+    /chat 请求的前置校验，任一项失败立即返回
     
-    handler = llm_handlers.get(llm_type, call_original_llm)
-    return handler(messages, student_id)
+    Returns:
+        (data, user_message, None) 校验通过
+        (None, None, Response)     校验失败时的错误响应
+    """
+    if not request.is_json:
+        return None, None, _error_response(_ERR_NOT_JSON, 400)
+    
+    # 按 Content-Length 拒绝超大请求，不读取请求体
+    if (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+        return None, None, _error_response(_ERR_TOO_LARGE, 413)
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None, None, _error_response(_ERR_INVALID_JSON, 400)
+    
+    # 流式请求由 chat_stream 自行校验
+    if data.get('stream'):
+        return data, None, None
+    
+    message = data.get('message')
+    user_message = message.strip() if isinstance(message, str) else ''
+    if not user_message or len(user_message) > MAX_MESSAGE_LENGTH or _CONTROL_ONLY_RE.match(user_message):
+        return None, None, _error_response(_ERR_INVALID_MESSAGE, 400)
+    
+    if data.get('llm_type', 'original') not in LLM_HANDLERS:
+        return None, None, _error_response(_ERR_INVALID_LLM_TYPE, 400)
+    
+    if not is_valid_session_id(data.get('session_id')):
+        return None, None, _error_response(_ERR_INVALID_SESSION_ID, 400)
+    
+    if not _API_KEY_OK:
+        return None, None, _error_response(_ERR_API_CONFIG, 500)
+    
+    return data, user_message, None
+
 
-# ================== 聊天接口 ==================
 @app.route('/chat', methods=['POST'])
 def chat():
     """处理聊天消息"""
     try:
-        if not request.is_json:
-            return jsonify({
-                'error': 'Content-Type must be application/json',
-                'success': False
-            }), 400
-        
-        data = request.get_json()
-        user_message = data.get('message', '').strip()
+        data, user_message, error_response = validate_chat_request()
+        if error_response is not None:
+            return error_response
+
+        # 客户端要求流式输出时，直接走 SSE 通道，避免阻塞到完整回答生成
+        if data.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+            return chat_stream()
+
         session_id = data.get('session_id')
         student_id = data.get('student_id', 'default')
         llm_type = data.get('llm_type', 'original')
-        context = data.get('context', [])
-        
-        if not user_message or len(user_message) > 2000:
-            return jsonify({
-                'error': 'Invalid message',
-                'success': False
-            }), 400
-        
-        if not API_KEY:
-            return jsonify({
-                'error': 'API configuration error',
-                'success': False
-            }), 500
         
-        # 创建新对话
+        # 新对话只生成 ID，拿到回复后随问答一起写入 Redis
+        new_conversation = None
         if not session_id:
-            session_id = str(uuid.uuid4())
+            session_id = uuid.uuid4().hex
             group_info = get_student_group(student_id) or {'group_id': 'unknown', 'group_name': 'unknown'}
-            
-            redis_db.create_conversation(
-                session_id, 
-                student_id, 
-                group_info, 
+            new_conversation = (
+                group_info,
                 llm_type,
                 user_message[:30] + ('...' if len(user_message) > 30 else '')
             )
-            
-            logger.info(f"Conversation {session_id} created")
-        
-        # 获取当前对话
-        conversation = redis_db.get_conversation(session_id)
+            conversation = None
+        else:
+            # 获取当前对话
+            conversation = redis_db.get_conversation(session_id)
         
-        # 构建消息列表
-        messages = []
-        if conversation and conversation.get('messages'):
-            # 使用之前的对话历史（最多20条）
-            for msg in conversation['messages'][-20:]:
-                messages.append({
-                    'role': msg['role'],
-                    'content': msg['content']
-                })
+        # 构建消息列表：按 token 预算截取历史（最多20条），控制 prefill 开销
+        messages = trim_history(conversation['messages']) if conversation and conversation.get('messages') else []
         
         # 确保最后一条是用户消息
         if not messages or messages[-1]['role'] != 'user':
             messages.append({'role': 'user', 'content': user_message})
         
-        logger.info(f"Calling LLM for student {student_id}, type: {llm_type}")
+        logger.info("Calling LLM for student %s, type: %s", student_id, llm_type)
         
-        # 调用LLM
-        result = route_llm_call(llm_type, messages, student_id)
-        
-        if 'choices' not in result or not result['choices']:
-            logger.error(f"Invalid API response: {result}")
-            return jsonify({
-                'error': 'Invalid response from AI service',
-                'success': False
-            }), 502
+        greeting_reply = get_greeting_reply(user_message)
         
-        ai_reply = result['choices'][0]['message']['content'].strip()
+        if greeting_reply:
+            # 简单问候：直接返回预设回复，不调用 LLM
+            ai_reply = greeting_reply
+            usage = None
+        else:
+            # 调用LLM
+            result = route_llm_call(llm_type, messages, student_id)
+            
+            if 'choices' not in result or not result['choices']:
+                logger.error(f"Invalid API response: {result}")
+                return jsonify({
+                    'error': 'Invalid response from AI service',
+                    'success': False
+                }), 502
+            
+            ai_reply = result['choices'][0]['message']['content'].strip()
+            usage = result.get('usage')
         
         if not ai_reply:
             return jsonify({
@@ -1263,17 +1391,13 @@ def chat():
                 'success': False
             }), 502
         
-        # 保存消息到Redis
-        user_word_count = len(user_message.split())
-        ai_word_count = len(ai_reply.split())
-        
-        redis_db.add_message_to_conversation(session_id, 'user', user_message, user_word_count)
-        redis_db.add_message_to_conversation(session_id, 'assistant', ai_reply, ai_word_count)
-        
-        # 更新学生统计
-        redis_db.add_to_student_stats(student_id, 2, 0)  # 2条消息
+        # 保存消息到Redis：同步写入，客户端拿到响应后立即刷新会话列表也能读到本轮问答
+        saved = persist_exchange(session_id, student_id, user_message, ai_reply, usage, new_conversation)
+        if new_conversation is not None and not saved:
+            # 新对话没有写入成功，不把不存在的会话 ID 交给客户端
+            session_id = None
         
-        logger.info(f"Successfully generated AI response for {llm_type}")
+        logger.info("Successfully generated AI response for %s", llm_type)
         
         return jsonify({
             'reply': ai_reply,
@@ -1289,44 +1413,74 @@ def chat():
         }), 500
 # ========== 数据导出接口 ==========
 
+CONVERSATION_EXPORT_FIELDS = [
+    'conversation_id', 'student_id', 'group_id', 'group_name',
+    'llm_type', 'title', 'created_at', 'message_count'
+]
+MESSAGE_EXPORT_FIELDS = [
+    'conversation_id', 'student_id', 'llm_type', 'role',
+    'content', 'timestamp', 'word_count'
+]
+STATISTICS_EXPORT_FIELDS = [
+    'student_id', 'group_id', 'group_name', 'llm_type', 'login_count',
+    'first_login_at', 'last_login_at', 'total_conversations', 'total_messages',
+    'total_duration', 'prompt_tokens', 'completion_tokens'
+]
+
+
+class _EchoWriter:
+    """csv.writer 的写入目标：直接返回写入的字符串，便于逐行 yield"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows, fieldnames, filename_prefix):
+    """
+    把 rows(字典迭代器) 逐行写成 CSV 流式返回，内存占用与总行数无关
+    
+    Returns:
+        Response；没有任何数据时返回 None
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return None
+    
+    writer = csv.DictWriter(_EchoWriter(), fieldnames=fieldnames, extrasaction='ignore', lineterminator='\n')
+    
+    def generate():
+        # UTF-8 BOM，Excel 打开时正确识别中文
+        yield '\ufeff' + writer.writeheader()
+        yield writer.writerow(first)
+        try:
+            for row in rows:
+                yield writer.writerow(row)
+        except Exception as e:
+            logger.error(f"CSV export stream error: {e}")
+    
+    filename = f'{filename_prefix}_{datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")}.csv'
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
 @app.route('/api/export/conversations', methods=['GET'])
 def export_conversations():
     """导出所有对话为CSV"""
     try:
-        import pandas as pd
-        from io import BytesIO
-        from flask import send_file
-        
-        conversations = redis_db.get_all_conversations()
-        
-        data = []
-        for conv in conversations:
-            data.append({
-                'conversation_id': conv['conversation_id'],
-                'student_id': conv['student_id'],
-                'group_id': conv['group_id'],
-                'group_name': conv['group_name'],
-                'llm_type': conv['llm_type'],
-                'title': conv['title'],
-                'created_at': conv['created_at'],
-                'message_count': conv['message_count']
-            })
+        response = stream_csv(
+            redis_db.iter_all_conversations(),
+            CONVERSATION_EXPORT_FIELDS,
+            'conversations'
+        )
         
-        if not data:
+        if response is None:
             return jsonify({'error': 'No data to export'}), 404
         
-        df = pd.DataFrame(data)
-        
-        output = BytesIO()
-        df.to_csv(output, index=False, encoding='utf-8-sig')
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'conversations_{datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")}.csv'
-        )
+        return response
     except Exception as e:
         logger.error(f"Export error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1336,27 +1490,16 @@ def export_conversations():
 def export_messages():
     """导出所有消息为CSV"""
     try:
-        import pandas as pd
-        from io import BytesIO
-        from flask import send_file
-        
-        messages = redis_db.get_all_messages()
+        response = stream_csv(
+            redis_db.iter_all_messages(),
+            MESSAGE_EXPORT_FIELDS,
+            'messages'
+        )
         
-        if not messages:
+        if response is None:
             return jsonify({'error': 'No data to export'}), 404
         
-        df = pd.DataFrame(messages)
-        
-        output = BytesIO()
-        df.to_csv(output, index=False, encoding='utf-8-sig')
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'messages_{datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")}.csv'
-        )
+        return response
     except Exception as e:
         logger.error(f"Export error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1366,27 +1509,16 @@ def export_messages():
 def export_statistics():
     """导出学生统计数据为CSV"""
     try:
-        import pandas as pd
-        from io import BytesIO
-        from flask import send_file
-        
-        stats = redis_db.export_statistics()
+        response = stream_csv(
+            redis_db.iter_statistics(),
+            STATISTICS_EXPORT_FIELDS,
+            'statistics'
+        )
         
-        if not stats:
+        if response is None:
             return jsonify({'error': 'No data to export'}), 404
         
-        df = pd.DataFrame(stats)
-        
-        output = BytesIO()
-        df.to_csv(output, index=False, encoding='utf-8-sig')
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'statistics_{datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")}.csv'
-        )
+        return response
     except Exception as e:
         logger.error(f"Export error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1402,36 +1534,26 @@ def get_sessions():
         if not student_id:
             return jsonify({'error': '缺少学生ID', 'success': False}), 400
         
-        logger.info(f"Loading sessions for student: {student_id}")
+        logger.info("Loading sessions for student: %s", student_id)
         
-        # 🔑 使用新的方法获取学生对话
-        conversations = redis_db.get_student_conversations(student_id)
+        # 🔑 只读取对话摘要（已按创建时间倒序），不加载完整消息
+        summaries = redis_db.get_student_conversation_summaries(student_id)
         
-        logger.info(f"Found {len(conversations)} conversations for student {student_id}")
+        logger.info("Found %s conversations for student %s", len(summaries), student_id)
         
         # 构建返回数据
-        student_sessions = []
-        for conv in conversations:
-            session_info = {
-                'id': conv['conversation_id'],
-                'title': conv.get('title', '无标题对话'),
-                'created_at': conv['created_at'],
-                'message_count': conv.get('message_count', 0)
+        student_sessions = [
+            {
+                'id': summary['conversation_id'],
+                'title': summary['title'],
+                'created_at': summary['created_at'],
+                'message_count': summary['message_count'],
+                'last_message': summary['last_message']
             }
-            
-            # 添加最后一条消息预览
-            if conv.get('messages') and len(conv['messages']) > 0:
-                last_msg = conv['messages'][-1]
-                session_info['last_message'] = last_msg['content'][:50] + ('...' if len(last_msg['content']) > 50 else '')
-            else:
-                session_info['last_message'] = ''
-            
-            student_sessions.append(session_info)
-        
-        # 按创建时间倒序排列
-        student_sessions.sort(key=lambda x: x['created_at'], reverse=True)
+            for summary in summaries
+        ]
         
-        logger.info(f"Returning {len(student_sessions)} sessions")
+        logger.info("Returning %s sessions", len(student_sessions))
         
         return jsonify({
             'sessions': student_sessions,
@@ -1491,7 +1613,7 @@ def delete_session(session_id):
         success = redis_db.delete_conversation(session_id)
         
         if success:
-            logger.info(f"Deleted conversation {session_id}")
+            logger.info("Deleted conversation %s", session_id)
             return jsonify({
                 'message': '会话已删除',
                 'success': True
@@ -1525,7 +1647,7 @@ def create_session():
                 'success': False
             }), 400
         
-        session_id = str(uuid.uuid4())
+        session_id = uuid.uuid4().hex
         group_info = get_student_group(student_id) or {
             'group_id': 'unknown',
             'group_name': 'unknown'
@@ -1553,17 +1675,25 @@ def create_session():
             'success': False
         }), 500
 
+# 错误响应体固定不变，导入时序列化一次
+_NOT_FOUND_BYTES = orjson.dumps({
+    'error': 'Endpoint not found',
+    'available_endpoints': ['/', '/login', '/chat', '/health', '/api/sessions', '/api/login']
+})
+_INTERNAL_ERROR_BYTES = orjson.dumps({'error': 'Internal server error'})
+
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({
-        'error': 'Endpoint not found',
-        'available_endpoints': ['/', '/login', '/chat', '/health', '/api/sessions', '/api/login']
-    }), 404
+    return _error_response(_NOT_FOUND_BYTES, 404)
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return _error_response(_ERR_TOO_LARGE, 413)
 
 @app.errorhandler(500)
 def internal_error(error):
     logger.error(f"Internal server error: {error}")
-    return jsonify({'error': 'Internal server error'}), 500
+    return _error_response(_INTERNAL_ERROR_BYTES, 500)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -1574,4 +1704,9 @@ if __name__ == '__main__':
     logger.info(f"Student groups loaded: {len(STUDENTS_CONFIG.get('groups', {}))}")
     logger.info(f"Redis available: {redis_db.available}")
     
-    app.run(debug=debug, port=port, host='0.0.0.0')
\ No newline at end of file
+    if debug:
+        app.run(debug=debug, port=port, host='0.0.0.0')
+    else:
+        # 等待通义千问返回时只挂起当前协程，单进程即可同时处理大量请求
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('0.0.0.0', port), app).serve_forever()
\ No newline at end of file
@@ -1,11 +1,19 @@
 import os
-import json
+import orjson
+import zlib
+import base64
 from datetime import datetime, timezone
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+# 对话数据压缩存储：超过阈值的对话 JSON 经 zlib 压缩后以 base64 文本写入（REST 接口只能传文本），
+# 带版本前缀；不带前缀的值按未压缩的旧格式读取
+CONVERSATION_ZLIB_PREFIX = 'z1:'
+CONVERSATION_COMPRESS_MIN_BYTES = 1024
+
 class RedisDB:
     """Upstash Redis REST API 数据管理 - 修复版"""
     
@@ -13,45 +21,60 @@ class RedisDB:
         self.rest_url = os.environ.get('UPSTASH_REDIS_REST_URL')
         self.rest_token = os.environ.get('UPSTASH_REDIS_REST_TOKEN')
         
-        self.available = False
+        # 连接测试推迟到第一次访问 available 时进行，冷启动时不必等待一次 PING 往返
+        self._available = None
         
+        # 复用 keep-alive 连接：每个请求会发出多条 Redis 命令，避免每条命令都重新 TCP+TLS 握手
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.rest_token}',
+            'Content-Type': 'application/json'
+        })
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+    
+    @property
+    def available(self):
+        """Redis 是否可用（首次访问时测试连接并缓存结果）"""
+        if self._available is None:
+            self._available = self._check_connection()
+        return self._available
+    
+    @available.setter
+    def available(self, value):
+        self._available = value
+    
+    def _check_connection(self):
+        """测试连接"""
         try:
             if not self.rest_url or not self.rest_token:
                 logger.warning("Upstash Redis credentials not found. Running without Redis.")
-                return
+                return False
             
-            # 测试连接
             response = self._execute_command(['PING'])
             if response and response.get('result') == 'PONG':
                 logger.info("✅ Successfully connected to Upstash Redis (REST API)")
-                self.available = True
-            else:
-                logger.warning("⚠️ Redis connection test failed")
+                return True
+            logger.warning("⚠️ Redis connection test failed")
+            return False
                 
         except Exception as e:
             logger.warning(f"⚠️ Redis connection error: {e}. Continuing without Redis.")
-            self.available = False
+            return False
     
     def _execute_command(self, command):
         """执行 Redis REST API 命令"""
-        if not self.available and not (self.rest_url and self.rest_token):
+        if not (self.rest_url and self.rest_token):
             return None
         
         try:
-            headers = {
-                'Authorization': f'Bearer {self.rest_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.post(
+            response = self.session.post(
                 self.rest_url,
-                headers=headers,
-                json=command,
+                data=orjson.dumps(command),
                 timeout=10  # 增加超时时间
             )
             
             if response.status_code == 200:
-                return response.json()
+                return orjson.loads(response.content)
             else:
                 logger.warning(f"Redis command failed: {response.status_code} - {response.text}")
                 return None
@@ -75,9 +98,9 @@ class RedisDB:
         result = self._execute_command(['GET', key])
         return result.get('result') if result else None
     
-    def _delete(self, key):
-        """删除键"""
-        result = self._execute_command(['DEL', key])
+    def _delete(self, *keys):
+        """删除键（可一次删除多个）"""
+        result = self._execute_command(['DEL', *keys])
         return result is not None
     
     def _keys(self, pattern):
@@ -103,25 +126,6 @@ class RedisDB:
                 return int(scan_result[0]), scan_result[1] or []
         return 0, []
     
-    def _sadd(self, key, *members):
-        """添加到集合"""
-        command = ['SADD', key] + list(members)
-        result = self._execute_command(command)
-        return result is not None
-    
-    def _smembers(self, key):
-        """获取集合所有成员"""
-        result = self._execute_command(['SMEMBERS', key])
-        if result and 'result' in result:
-            return result.get('result', []) or []
-        return []
-    
-    def _srem(self, key, *members):
-        """从集合中移除成员"""
-        command = ['SREM', key] + list(members)
-        result = self._execute_command(command)
-        return result is not None
-    
     def _hset(self, key, mapping):
         """设置哈希表"""
         command = ['HSET', key]
@@ -149,6 +153,60 @@ class RedisDB:
         """设置键过期时间"""
         result = self._execute_command(['EXPIRE', key, str(seconds)])
         return result is not None
+    
+    def _mget(self, keys):
+        """
+        一次获取多个键的值（不存在的键返回 None）
+        
+        请求失败时返回 None 而不是全 None 列表，调用方据此区分"键不存在"与"没读到"，
+        不会把读取失败当成对话已过期去清理索引
+        """
+        if not keys:
+            return []
+        result = self._execute_command(['MGET'] + list(keys))
+        if result and 'result' in result:
+            return result.get('result') or []
+        return None
+    
+    def _zadd(self, key, score, member):
+        """添加到有序集合"""
+        result = self._execute_command(['ZADD', key, str(score), member])
+        return result is not None
+    
+    def _zrevrange(self, key, start=0, stop=-1):
+        """按分数从高到低获取有序集合成员"""
+        result = self._execute_command(['ZREVRANGE', key, str(start), str(stop)])
+        if result and 'result' in result:
+            return result.get('result', []) or []
+        return []
+    
+    def _zrem(self, key, *members):
+        """从有序集合中移除成员"""
+        command = ['ZREM', key] + list(members)
+        result = self._execute_command(command)
+        return result is not None
+    
+    def _pipeline(self, commands):
+        """通过 Upstash /pipeline 接口在一次 HTTP 往返中执行多条命令"""
+        if not (self.rest_url and self.rest_token):
+            return None
+        
+        try:
+            response = self.session.post(
+                f"{self.rest_url}/pipeline",
+                data=orjson.dumps(commands),
+                timeout=10
+            )
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            else:
+                logger.warning(f"Redis pipeline failed: {response.status_code} - {response.text}")
+                return None
+                
+        except Exception as e:
+            logger.warning(f"Redis pipeline error: {e}")
+            return None
 
     # ============ 学生数据操作 ============
     
@@ -160,7 +218,7 @@ class RedisDB:
         
         try:
             key = f"student:{student_id}"
-            return self._set(key, json.dumps(student_data), ex=86400*365)
+            return self._set(key, orjson.dumps(student_data).decode(), ex=86400*365)
         except Exception as e:
             logger.warning(f"Error saving student: {e}")
             return False
@@ -173,7 +231,7 @@ class RedisDB:
         try:
             key = f"student:{student_id}"
             data = self._get(key)
-            return json.loads(data) if data else None
+            return orjson.loads(data) if data else None
         except Exception as e:
             logger.warning(f"Error getting student: {e}")
             return None
@@ -204,7 +262,7 @@ class RedisDB:
         
         try:
             key = f"personality:{student_id}"
-            return self._set(key, json.dumps(personality_data), ex=86400*365)  # 保存1年
+            return self._set(key, orjson.dumps(personality_data).decode(), ex=86400*365)  # 保存1年
         except Exception as e:
             logger.warning(f"Error saving personality: {e}")
             return False
@@ -217,7 +275,7 @@ class RedisDB:
         try:
             key = f"personality:{student_id}"
             data = self._get(key)
-            return json.loads(data) if data else None
+            return orjson.loads(data) if data else None
         except Exception as e:
             logger.warning(f"Error getting personality: {e}")
             return None
@@ -235,25 +293,23 @@ class RedisDB:
             logger.warning(f"Error checking personality: {e}")
             return False
     
-    def get_all_personality_data(self):
-        """获取所有学生人格测试数据"""
+    def iter_all_personality_data(self):
+        """逐个产出所有学生人格测试数据"""
         if not self.available:
-            return []
+            return
         
         try:
-            keys = self._keys("personality:*")
-            personality_list = []
-            for key in keys:
-                data = self._get(key)
-                if data:
-                    try:
-                        personality_list.append(json.loads(data))
-                    except json.JSONDecodeError:
-                        logger.warning(f"Invalid JSON in key {key}")
-            return personality_list
+            for key, data in self._scan_values("personality:*"):
+                try:
+                    yield orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    logger.warning(f"Invalid JSON in key {key}")
         except Exception as e:
-            logger.warning(f"Error getting all personality data: {e}")
-            return []
+            logger.warning(f"Error iterating personality data: {e}")
+    
+    def get_all_personality_data(self):
+        """获取所有学生人格测试数据"""
+        return list(self.iter_all_personality_data())
 
     # ============ 对话数据操作 ============
     
@@ -264,6 +320,7 @@ class RedisDB:
             return True
         
         try:
+            now = datetime.now(timezone.utc)
             conv_data = {
                 'conversation_id': conv_id,
                 'student_id': student_id,
@@ -271,19 +328,24 @@ class RedisDB:
                 'group_name': group_info.get('group_name') if group_info else 'unknown',
                 'llm_type': llm_type,
                 'title': title,
-                'created_at': datetime.now(timezone.utc).isoformat(),
+                'created_at': now.isoformat(),
                 'message_count': 0,
                 'messages': []
             }
             key = f"conversation:{conv_id}"
-            success = self._set(key, json.dumps(conv_data), ex=86400*30)
+            index_key = self._student_index_key(student_id)
+            
+            # 🔑 对话数据与学生对话索引(按创建时间排序)在一次往返中写入
+            results = self._pipeline([
+                ['SET', key, self._encode_conversation(conv_data), 'EX', str(86400*30)],
+                self._summary_command(conv_data),
+                ['ZADD', index_key, str(now.timestamp()), conv_id],
+                ['EXPIRE', index_key, str(86400*30)]
+            ])
+            success = bool(results) and 'error' not in results[0]
             
-            # 🔑 维护学生对话索引
             if success:
-                index_key = f"student_conversations:{student_id}"
-                self._sadd(index_key, conv_id)
-                self._expire(index_key, 86400*30)
-                logger.info(f"Created conversation {conv_id} for student {student_id}")
+                logger.info("Created conversation %s for student %s", conv_id, student_id)
             
             return success
         except Exception as e:
@@ -299,9 +361,9 @@ class RedisDB:
             key = f"conversation:{conv_id}"
             data = self._get(key)
             if data:
-                return json.loads(data)
+                return self._decode_conversation(data)
             else:
-                logger.debug(f"Conversation {conv_id} not found")
+                logger.debug("Conversation %s not found", conv_id)
                 return None
         except Exception as e:
             logger.warning(f"Error getting conversation: {e}")
@@ -330,11 +392,161 @@ class RedisDB:
             conv['message_count'] = len(conv['messages'])
             
             key = f"conversation:{conv_id}"
-            return self._set(key, json.dumps(conv), ex=86400*30)
+            return self._pipeline([
+                ['SET', key, self._encode_conversation(conv), 'EX', str(86400*30)],
+                self._summary_command(conv)
+            ]) is not None
         except Exception as e:
             logger.warning(f"Error adding message to conversation: {e}")
             return False
     
+    def record_exchange(self, conv_id, student_id, user_message, user_word_count, ai_reply, ai_word_count,
+                        prompt_tokens=0, completion_tokens=0):
+        """
+        保存一轮问答(用户消息 + AI 回复)并更新学生统计
+        
+        写入前重新读取对话，之后对话写回与统计累加在同一个 pipeline 中完成（共两次往返）。
+        不复用 LLM 调用之前读到的对话：期间同一会话的其他轮次可能已经写入，写回旧数据会覆盖它们
+        """
+        if not self.available:
+            logger.debug("Redis unavailable, skipping record_exchange")
+            return True
+        
+        try:
+            conv = self.get_conversation(conv_id)
+            if not conv:
+                logger.warning(f"Conversation {conv_id} not found when adding message")
+                self.add_to_student_stats(student_id, 2, 0, prompt_tokens, completion_tokens)
+                return False
+            
+            timestamp = datetime.now(timezone.utc).isoformat()
+            conv['messages'].append({
+                'role': 'user',
+                'content': user_message,
+                'timestamp': timestamp,
+                'word_count': user_word_count
+            })
+            conv['messages'].append({
+                'role': 'assistant',
+                'content': ai_reply,
+                'timestamp': timestamp,
+                'word_count': ai_word_count
+            })
+            conv['message_count'] = len(conv['messages'])
+            
+            key = f"conversation:{conv_id}"
+            commands = [
+                ['SET', key, self._encode_conversation(conv), 'EX', str(86400*30)],
+                self._summary_command(conv)
+            ]
+            commands.extend(self._student_stats_commands(
+                student_id, 2, 0, prompt_tokens, completion_tokens  # 2条消息
+            ))
+            return self._pipeline(commands) is not None
+        except Exception as e:
+            logger.warning(f"Error recording exchange: {e}")
+            return False
+    
+    @staticmethod
+    def _student_index_key(student_id):
+        """学生对话索引：有序集合，score 为对话创建时间戳"""
+        return f"student_conversation_index:{student_id}"
+    
+    @staticmethod
+    def _legacy_student_index_key(student_id):
+        """旧版学生对话索引(无序集合)，读取时迁移到有序集合"""
+        return f"student_conversations:{student_id}"
+    
+    def _student_conversation_ids(self, student_id):
+        """
+        获取学生的对话 ID（按创建时间倒序）
+        
+        与旧版 SET 索引在同一次往返中读取；旧索引仍有成员时按对话 created_at 并入有序集合，再删除旧键
+        """
+        index_key = self._student_index_key(student_id)
+        legacy_key = self._legacy_student_index_key(student_id)
+        results = self._pipeline([
+            ['SMEMBERS', legacy_key],
+            ['ZREVRANGE', index_key, '0', '-1']
+        ])
+        if not results:
+            return self._zrevrange(index_key)
+        
+        legacy_ids = results[0].get('result') or []
+        conv_ids = results[1].get('result') or []
+        if not legacy_ids:
+            return conv_ids
+        
+        values = self._mget([f"conversation:{conv_id}" for conv_id in legacy_ids])
+        if values is None:
+            # 没读到对话数据时保留旧索引，下次读取再迁移
+            return conv_ids
+        
+        commands = []
+        for conv_id, data in zip(legacy_ids, values):
+            if not data:
+                continue
+            try:
+                conv = self._decode_conversation(data)
+            except (ValueError, zlib.error):
+                logger.warning(f"Invalid JSON in conversation {conv_id}")
+                continue
+            commands.append(['ZADD', index_key, str(self._created_at_score(conv)), conv_id])
+        if commands:
+            commands.append(['EXPIRE', index_key, str(86400*30)])
+        commands.append(['DEL', legacy_key])
+        
+        if self._pipeline(commands) is None:
+            return conv_ids
+        logger.info("Migrated %s legacy conversation IDs for student %s", len(legacy_ids), student_id)
+        return self._zrevrange(index_key)
+    
+    @staticmethod
+    def _encode_conversation(conv):
+        """序列化对话；较大的对话压缩后存储"""
+        raw = orjson.dumps(conv)
+        if len(raw) < CONVERSATION_COMPRESS_MIN_BYTES:
+            return raw.decode()
+        return CONVERSATION_ZLIB_PREFIX + base64.b64encode(zlib.compress(raw, 6)).decode('ascii')
+    
+    @staticmethod
+    def _decode_conversation(data):
+        """解析对话数据，兼容未压缩的旧数据"""
+        if data.startswith(CONVERSATION_ZLIB_PREFIX):
+            data = zlib.decompress(base64.b64decode(data[len(CONVERSATION_ZLIB_PREFIX):]))
+        return orjson.loads(data)
+    
+    @staticmethod
+    def _summary_key(conv_id):
+        """对话摘要：会话列表只需要的几个字段，避免列表接口读取完整消息"""
+        return f"conversation_summary:{conv_id}"
+    
+    @staticmethod
+    def build_conversation_summary(conv):
+        """从完整对话生成摘要(标题、创建时间、消息数、最后一条消息预览)"""
+        messages = conv.get('messages') or []
+        last_content = messages[-1]['content'] if messages else ''
+        return {
+            'conversation_id': conv['conversation_id'],
+            'title': conv.get('title', '无标题对话'),
+            'created_at': conv['created_at'],
+            'message_count': conv.get('message_count', 0),
+            'last_message': last_content[:50] + ('...' if len(last_content) > 50 else '')
+        }
+    
+    @classmethod
+    def _summary_command(cls, conv):
+        """写入对话摘要的 SET 命令，随对话本身一起写入、同样的过期时间"""
+        return ['SET', cls._summary_key(conv['conversation_id']),
+                orjson.dumps(cls.build_conversation_summary(conv)).decode(), 'EX', str(86400*30)]
+    
+    @staticmethod
+    def _created_at_score(conv):
+        try:
+            return datetime.fromisoformat(conv.get('created_at', '')).timestamp()
+        except ValueError:
+            return 0
+    
     def get_student_conversations(self, student_id):
         """🔑 获取特定学生的所有对话 - 使用索引"""
         if not self.available:
@@ -342,55 +554,129 @@ class RedisDB:
             return []
         
         try:
-            # 方法1: 使用学生对话索引（更快）
-            index_key = f"student_conversations:{student_id}"
-            conv_ids = self._smembers(index_key)
+            # 方法1: 使用学生对话索引（有序集合，已按创建时间倒序）
+            index_key = self._student_index_key(student_id)
+            conv_ids = self._student_conversation_ids(student_id)
             
-            logger.info(f"Found {len(conv_ids)} conversation IDs for student {student_id}")
+            logger.info("Found %s conversation IDs for student %s", len(conv_ids), student_id)
             
             conversations = []
-            for conv_id in conv_ids:
-                conv = self.get_conversation(conv_id)
-                if conv:
-                    conversations.append(conv)
+            expired_ids = []
+            values = self._mget([f"conversation:{conv_id}" for conv_id in conv_ids])
+            if values is None:
+                logger.warning(f"Failed to fetch conversations for student {student_id}")
+                return []
+            for conv_id, data in zip(conv_ids, values):
+                if data:
+                    try:
+                        conversations.append(self._decode_conversation(data))
+                    except (ValueError, zlib.error):
+                        logger.warning(f"Invalid JSON in conversation {conv_id}")
                 else:
-                    # 对话已过期，从索引中移除
-                    self._srem(index_key, conv_id)
+                    expired_ids.append(conv_id)
+            
+            # 对话已过期，从索引中移除
+            if expired_ids:
+                self._zrem(index_key, *expired_ids)
             
             # 如果索引为空，尝试使用 KEYS 作为备选方案
             if not conversations:
-                logger.info(f"Index empty, trying KEYS fallback for student {student_id}")
+                logger.info("Index empty, trying KEYS fallback for student %s", student_id)
                 conversations = self._get_student_conversations_fallback(student_id)
+                # 按创建时间倒序排列
+                conversations.sort(key=lambda x: x.get('created_at', ''), reverse=True)
             
-            # 按创建时间倒序排列
-            conversations.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-            
-            logger.info(f"Returning {len(conversations)} conversations for student {student_id}")
+            logger.info("Returning %s conversations for student %s", len(conversations), student_id)
             return conversations
             
         except Exception as e:
             logger.error(f"Error getting student conversations: {e}")
             return []
     
+    def get_student_conversation_summaries(self, student_id):
+        """
+        获取学生的对话摘要列表（按创建时间倒序），供会话列表使用
+        
+        只读取摘要键；早于摘要功能创建的对话读取一次完整数据生成摘要并补写
+        """
+        if not self.available:
+            logger.debug("Redis unavailable, returning empty list")
+            return []
+        
+        try:
+            index_key = self._student_index_key(student_id)
+            conv_ids = self._student_conversation_ids(student_id)
+            if not conv_ids:
+                # 索引为空时走完整对话的查询（含 KEYS 备选方案与索引重建）
+                return [self.build_conversation_summary(conv)
+                        for conv in self.get_student_conversations(student_id)]
+            
+            summaries = {}
+            missing_ids = []
+            values = self._mget([self._summary_key(conv_id) for conv_id in conv_ids])
+            if values is None:
+                logger.warning(f"Failed to fetch conversation summaries for student {student_id}")
+                return []
+            for conv_id, data in zip(conv_ids, values):
+                if data:
+                    try:
+                        summaries[conv_id] = orjson.loads(data)
+                        continue
+                    except orjson.JSONDecodeError:
+                        # 摘要损坏时按缺失处理，下面从完整对话重新生成并覆盖
+                        logger.warning(f"Invalid JSON in conversation summary {conv_id}")
+                missing_ids.append(conv_id)
+            
+            if missing_ids:
+                backfill = []
+                expired_ids = []
+                values = self._mget([f"conversation:{conv_id}" for conv_id in missing_ids])
+                if values is None:
+                    # 读取失败：本次只返回已有摘要，不补写也不清理索引
+                    logger.warning(f"Failed to fetch conversations for student {student_id}")
+                    values = []
+                for conv_id, data in zip(missing_ids, values):
+                    if data:
+                        try:
+                            conv = self._decode_conversation(data)
+                        except (ValueError, zlib.error):
+                            logger.warning(f"Invalid JSON in conversation {conv_id}")
+                            continue
+                        summaries[conv_id] = self.build_conversation_summary(conv)
+                        backfill.append(self._summary_command(conv))
+                    else:
+                        expired_ids.append(conv_id)
+                
+                if backfill:
+                    self._pipeline(backfill)
+                # 对话已过期，从索引中移除
+                if expired_ids:
+                    self._zrem(index_key, *expired_ids)
+            
+            return [summaries[conv_id] for conv_id in conv_ids if conv_id in summaries]
+        except Exception as e:
+            logger.error(f"Error getting conversation summaries: {e}")
+            return []
+    
     def _get_student_conversations_fallback(self, student_id):
         """使用 KEYS 作为备选方案获取学生对话"""
         try:
             keys = self._keys("conversation:*")
-            logger.info(f"KEYS fallback found {len(keys)} total conversation keys")
+            logger.info("KEYS fallback found %s total conversation keys", len(keys))
             
             conversations = []
-            index_key = f"student_conversations:{student_id}"
+            index_key = self._student_index_key(student_id)
             
             for key in keys:
                 data = self._get(key)
                 if data:
                     try:
-                        conv = json.loads(data)
+                        conv = self._decode_conversation(data)
                         if conv.get('student_id') == student_id:
                             conversations.append(conv)
                             # 重建索引
-                            self._sadd(index_key, conv['conversation_id'])
-                    except json.JSONDecodeError:
+                            self._zadd(index_key, self._created_at_score(conv), conv['conversation_id'])
+                    except (ValueError, zlib.error):
                         logger.warning(f"Invalid JSON in key {key}")
             
             if conversations:
@@ -413,70 +699,117 @@ class RedisDB:
                 student_id = conv.get('student_id')
                 if student_id:
                     # 从索引中移除
-                    index_key = f"student_conversations:{student_id}"
-                    self._srem(index_key, conv_id)
+                    self._zrem(self._student_index_key(student_id), conv_id)
             
-            # 删除对话
+            # 删除对话及其摘要
             key = f"conversation:{conv_id}"
-            return self._delete(key)
+            return self._delete(key, self._summary_key(conv_id))
         except Exception as e:
             logger.error(f"Error deleting conversation: {e}")
             return False
 
     # ============ 统计数据操作 ============
     
-    def add_to_student_stats(self, student_id, messages_count, duration_seconds):
-        """更新学生统计"""
+    @staticmethod
+    def _student_stats_commands(student_id, messages_count, duration_seconds,
+                                prompt_tokens=0, completion_tokens=0):
+        """学生统计的累加命令(HINCRBY 原子累加，无需先读后写)"""
+        key = f"stats:{student_id}"
+        commands = [
+            ['HINCRBY', key, 'total_messages', str(messages_count)],
+            ['HINCRBYFLOAT', key, 'total_duration', str(float(duration_seconds))],
+            ['HINCRBY', key, 'total_conversations', '1']
+        ]
+        # 模型返回的 token 用量
+        if prompt_tokens:
+            commands.append(['HINCRBY', key, 'prompt_tokens', str(prompt_tokens)])
+        if completion_tokens:
+            commands.append(['HINCRBY', key, 'completion_tokens', str(completion_tokens)])
+        commands.append(['EXPIRE', key, str(86400*365)])
+        return commands
+    
+    def add_to_student_stats(self, student_id, messages_count, duration_seconds,
+                             prompt_tokens=0, completion_tokens=0):
+        """更新学生统计（一次往返）"""
         if not self.available:
             logger.debug("Redis unavailable, skipping add_to_student_stats")
             return True
         
         try:
-            key = f"stats:{student_id}"
-            
-            stats = self._hgetall(key)
-            if not stats:
-                stats = {
-                    'total_messages': '0',
-                    'total_duration': '0.0',
-                    'total_conversations': '0'
-                }
-            
-            stats['total_messages'] = str(int(stats.get('total_messages', 0)) + messages_count)
-            stats['total_duration'] = str(float(stats.get('total_duration', 0)) + duration_seconds)
-            stats['total_conversations'] = str(int(stats.get('total_conversations', 0)) + 1)
-            
-            self._hset(key, stats)
-            self._expire(key, 86400*365)
-            return True
+            commands = self._student_stats_commands(
+                student_id, messages_count, duration_seconds, prompt_tokens, completion_tokens
+            )
+            return self._pipeline(commands) is not None
         except Exception as e:
             logger.warning(f"Error updating student stats: {e}")
             return False
     
-    # ============ 批量导出操作 ============
+    # ============ LLM 响应缓存 ============
     
-    def get_all_conversations(self):
-        """获取所有对话"""
+    def get_cached_response(self, cache_key):
+        """获取缓存的 LLM 响应"""
         if not self.available:
-            return []
+            return None
         
         try:
-            keys = self._keys("conversation:*")
-            logger.info(f"get_all_conversations: found {len(keys)} keys")
-            
-            conversations = []
-            for key in keys:
-                data = self._get(key)
+            key = f"llm_cache:{cache_key}"
+            data = self._get(key)
+            return orjson.loads(data) if data else None
+        except Exception as e:
+            logger.warning(f"Error getting cached response: {e}")
+            return None
+    
+    def cache_response(self, cache_key, response_data, ex=3600):
+        """缓存 LLM 响应"""
+        if not self.available:
+            return False
+        
+        try:
+            key = f"llm_cache:{cache_key}"
+            return self._set(key, orjson.dumps(response_data).decode(), ex=ex)
+        except Exception as e:
+            logger.warning(f"Error caching response: {e}")
+            return False
+    
+    # ============ 批量导出操作 ============
+    
+    def _scan_batches(self, pattern, batch_size=100):
+        """用 SCAN 分批遍历匹配的键，逐批产出键列表"""
+        seen = set()  # SCAN 可能重复返回同一个键
+        cursor = 0
+        while True:
+            cursor, keys = self._scan(cursor, match=pattern, count=batch_size)
+            keys = [key for key in keys if key not in seen]
+            seen.update(keys)
+            if keys:
+                yield keys
+            if cursor == 0:
+                break
+    
+    def _scan_values(self, pattern, batch_size=100):
+        """用 SCAN 分批遍历匹配的键，每批用一次 MGET 取值，逐个产出 (key, value)"""
+        for keys in self._scan_batches(pattern, batch_size):
+            for key, data in zip(keys, self._mget(keys) or []):
                 if data:
-                    try:
-                        conversations.append(json.loads(data))
-                    except json.JSONDecodeError:
-                        logger.warning(f"Invalid JSON in key {key}")
-            
-            return conversations
+                    yield key, data
+    
+    def iter_all_conversations(self):
+        """逐个产出所有对话（不一次性加载到内存）"""
+        if not self.available:
+            return
+        
+        try:
+            for key, data in self._scan_values("conversation:*"):
+                try:
+                    yield self._decode_conversation(data)
+                except (ValueError, zlib.error):
+                    logger.warning(f"Invalid JSON in key {key}")
         except Exception as e:
-            logger.warning(f"Error getting all conversations: {e}")
-            return []
+            logger.warning(f"Error iterating conversations: {e}")
+    
+    def get_all_conversations(self):
+        """获取所有对话"""
+        return list(self.iter_all_conversations())
     
     def get_all_students(self):
         """获取所有学生"""
@@ -489,75 +822,76 @@ class RedisDB:
             for key in keys:
                 data = self._get(key)
                 if data:
-                    students.append(json.loads(data))
+                    students.append(orjson.loads(data))
             return students
         except Exception as e:
             logger.warning(f"Error getting all students: {e}")
             return []
     
+    def iter_all_messages(self):
+        """逐条产出所有消息(展平)"""
+        for conv in self.iter_all_conversations():
+            for msg in conv.get('messages', []):
+                yield {
+                    'conversation_id': conv['conversation_id'],
+                    'student_id': conv['student_id'],
+                    'llm_type': conv['llm_type'],
+                    'role': msg['role'],
+                    'content': msg['content'],
+                    'timestamp': msg['timestamp'],
+                    'word_count': msg['word_count']
+                }
+    
     def get_all_messages(self):
         """获取所有消息(展平)"""
+        return list(self.iter_all_messages())
+    
+    def iter_statistics(self):
+        """
+        逐个产出学生统计记录
+        
+        每批 stats 键用一次 MGET 取学生信息、一次 pipeline 取全部 HGETALL，
+        往返次数与批数成正比，而不是与学生数成正比
+        """
         if not self.available:
-            return []
+            return
         
         try:
-            conversations = self.get_all_conversations()
-            all_messages = []
-            
-            for conv in conversations:
-                for msg in conv.get('messages', []):
-                    msg_record = {
-                        'conversation_id': conv['conversation_id'],
-                        'student_id': conv['student_id'],
-                        'llm_type': conv['llm_type'],
-                        'role': msg['role'],
-                        'content': msg['content'],
-                        'timestamp': msg['timestamp'],
-                        'word_count': msg['word_count']
-                    }
-                    all_messages.append(msg_record)
-            
-            return all_messages
+            for stats_keys in self._scan_batches("stats:*"):
+                student_ids = [key.split(':', 1)[1] for key in stats_keys]
+                students = self._mget([f"student:{student_id}" for student_id in student_ids]) or []
+                stats_results = self._pipeline([['HGETALL', key] for key in stats_keys]) or []
+                
+                for i, (key, student_id) in enumerate(zip(stats_keys, student_ids)):
+                    try:
+                        student_raw = students[i] if i < len(students) else None
+                        student_data = orjson.loads(student_raw) if student_raw else {}
+                        items = (stats_results[i].get('result') if i < len(stats_results) else None) or []
+                        stats_data = {items[j]: items[j+1] for j in range(0, len(items), 2)}
+                        
+                        yield {
+                            'student_id': student_id,
+                            'group_id': student_data.get('group_id', ''),
+                            'group_name': student_data.get('group_name', ''),
+                            'llm_type': student_data.get('llm_type', ''),
+                            'login_count': student_data.get('login_count', 0),
+                            'first_login_at': student_data.get('first_login_at', ''),
+                            'last_login_at': student_data.get('last_login_at', ''),
+                            'total_conversations': stats_data.get('total_conversations', 0),
+                            'total_messages': stats_data.get('total_messages', 0),
+                            'total_duration': stats_data.get('total_duration', 0),
+                            'prompt_tokens': stats_data.get('prompt_tokens', 0),
+                            'completion_tokens': stats_data.get('completion_tokens', 0)
+                        }
+                    except Exception as e:
+                        logger.warning(f"Error processing stats for key {key}: {e}")
+                        continue
         except Exception as e:
-            logger.warning(f"Error getting all messages: {e}")
-            return []
+            logger.warning(f"Error exporting statistics: {e}")
     
     def export_statistics(self):
         """导出统计数据"""
-        if not self.available:
-            return []
-        
-        try:
-            stats_keys = self._keys("stats:*")
-            statistics = []
-            
-            for key in stats_keys:
-                try:
-                    student_id = key.split(':')[1]
-                    student_data = self.get_student(student_id)
-                    stats_data = self._hgetall(key)
-                    
-                    record = {
-                        'student_id': student_id,
-                        'group_id': student_data.get('group_id') if student_data else '',
-                        'group_name': student_data.get('group_name') if student_data else '',
-                        'llm_type': student_data.get('llm_type') if student_data else '',
-                        'login_count': student_data.get('login_count', 0) if student_data else 0,
-                        'first_login_at': student_data.get('first_login_at') if student_data else '',
-                        'last_login_at': student_data.get('last_login_at') if student_data else '',
-                        'total_conversations': stats_data.get('total_conversations', 0),
-                        'total_messages': stats_data.get('total_messages', 0),
-                        'total_duration': stats_data.get('total_duration', 0)
-                    }
-                    statistics.append(record)
-                except Exception as e:
-                    logger.warning(f"Error processing stats for key {key}: {e}")
-                    continue
-            
-            return statistics
-        except Exception as e:
-            logger.warning(f"Error exporting statistics: {e}")
-            return []
+        return list(self.iter_statistics())
 
 # 单例
 _redis_instance = None
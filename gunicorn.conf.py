@@ -0,0 +1,18 @@
+# Gunicorn 生产环境配置
+# 用法: gunicorn wsgi:app
+#
+# /chat 与 /chat/stream 的耗时几乎全部花在等待通义千问 API 返回上（I/O 密集），
+# 使用 gevent worker：gunicorn 会在加载应用前 monkey-patch 标准库 socket，
+# requests 的阻塞调用变为协程切换，一个进程即可同时挂起上千个等待上游的请求。
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# SRL+Ethics 工作流关键路径上有 2 次串行 LLM 调用（并行 Agent + 最终回答），留足余量
+timeout = 180
+keepalive = 5
@@ -0,0 +1,10 @@
+# 非 Vercel 部署的 WSGI 入口: gunicorn wsgi:app
+#
+# 必须在导入 requests / urllib3 / ssl 之前完成 monkey-patch，否则已创建的
+# socket、ssl、threading 对象仍是阻塞版本（gunicorn 开启 preload_app 时应用
+# 先在 master 进程加载，gevent worker 自己的 patch 来得太晚）。
+from gevent import monkey
+
+monkey.patch_all()
+
+from api.index import app  # noqa: E402